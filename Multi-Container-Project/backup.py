@@ -0,0 +1,305 @@
+"""SiteScope export / import.
+
+Streams visits out of Redis into a file and back, in constant memory,
+using the key schema from count.py (REDIS_HOST / REDIS_PORT as for the app).
+
+    python backup.py export visits.ndjson                  # full history from vc:stream
+    python backup.py export recent.csv --source list       # the capped vc:visits list
+    python backup.py export visits.parquet --from 2024-05-01 --to 2024-06-01
+    python backup.py import visits.ndjson --rate 20000
+
+Formats: ndjson, csv, parquet (needs `pip install pyarrow`), picked from the
+file extension or --format; "-" reads stdin / writes stdout (ndjson, csv).
+Each record is one visit: id (stream id, empty for list exports),
+created_date, ip_address, user_agent, count_after.
+
+Import expects records oldest first (as exported). Each batch is one
+script call: per record, XADD to vc:stream with the original id and, only
+if that succeeded, INCR vc:count, LPUSH vc:visits and (unless --no-rollups)
+bump the day/hour rollups and add the visit to the unique-visitor
+HyperLogLogs and top-N sketches of its day/hour, as live ingest does. Imported visits are numbered by vc:count like
+live ones, so vc:visits stays gapless and ordered by count_after even when
+importing into a store that already has visits (or after an import that
+died halfway); only into an empty list is the first record's exported
+count_after kept, so a full restore keeps its numbers. Records not newer
+than the stream's last entry when the import started (by id, or by
+created_date for rows without one) are skipped, so re-running an import
+adds nothing.
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+import time
+
+import count
+
+FIELDS = ["id", "created_date", "ip_address", "user_agent", "count_after"]
+
+# Import one batch. KEYS[1..3] = counter, stream, list; then per record its
+# day and hour rollups, day and hour HyperLogLogs and ip and user agent top-N
+# sketches (none with ARGV[2] = 0). ARGV[1] = list cap, ARGV[2] = rollups
+# (0/1), ARGV[3..4] = day/hour TTL, ARGV[5] = top-N capacity, then per record
+# its stream id, v1 record prefix, exported count_after, ip, user agent and
+# user agent member (its id, or "~<user agent>", as INGEST_LUA ranks it).
+# Like INGEST_LUA the script appends count_after, the next value of the
+# counter. A record whose XADD fails (id not above the stream's top) writes
+# nothing.
+# Returns one value per record: its new count_after, or 0 if skipped.
+IMPORT_LUA = count.SPACE_SAVING_LUA + """
+local cap, rollups = tonumber(ARGV[1]), ARGV[2] == '1'
+local k = tonumber(ARGV[5])
+local n = tonumber(redis.call('GET', KEYS[1]) or '0')
+local empty = redis.call('LLEN', KEYS[3]) == 0
+local written, pushed = {}, 0
+for i = 0, (#ARGV - 5) / 6 - 1 do
+  local a = 6 + 6 * i
+  local id, prefix = ARGV[a], ARGV[a + 1]
+  local c = n + 1
+  if empty then
+    c = math.max(c, tonumber(ARGV[a + 2]))   -- restore: keep the exported numbering
+  end
+  local rec = prefix .. c
+  local res = redis.pcall('XADD', KEYS[2], id, 'r', rec)
+  if type(res) == 'table' and res.err then
+    written[i + 1] = 0
+  else
+    n, empty = c, false
+    written[i + 1] = n
+    redis.call('LPUSH', KEYS[3], rec)
+    pushed = pushed + 1
+    if rollups then
+      local j = 4 + 6 * i
+      for h = 0, 1 do   -- day, then hour
+        local ttl = ARGV[3 + h]
+        redis.call('INCR', KEYS[j + h])
+        redis.call('EXPIRE', KEYS[j + h], ttl)
+        redis.call('PFADD', KEYS[j + 2 + h], ARGV[a + 3] .. '|' .. ARGV[a + 4])
+        redis.call('EXPIRE', KEYS[j + 2 + h], ttl)
+      end
+      space_saving(KEYS[j + 4], ARGV[a + 3], 1, k)
+      space_saving(KEYS[j + 5], ARGV[a + 5], 1, k)
+      redis.call('EXPIRE', KEYS[j + 4], ARGV[3])
+      redis.call('EXPIRE', KEYS[j + 5], ARGV[3])
+    end
+  end
+end
+if pushed > 0 then
+  redis.call('SET', KEYS[1], n)
+  redis.call('LTRIM', KEYS[3], 0, cap - 1)
+end
+return written
+"""
+
+
+# --- Helpers ---
+class Progress:
+    """Throughput report on stderr, at most every `every` seconds and once at the end."""
+
+    def __init__(self, verb, every=2.0):
+        self.verb = verb
+        self.every = every
+        self.n = self.skipped = 0
+        self.t0 = self.last = time.perf_counter()
+
+    def add(self, n, skipped=0):
+        self.n += n
+        self.skipped += skipped
+        now = time.perf_counter()
+        if now - self.last >= self.every:
+            self.last = now
+            self._print(now)
+
+    def done(self):
+        self._print(time.perf_counter())
+
+    def _print(self, now):
+        wall = max(now - self.t0, 1e-9)
+        skipped = f" ({self.skipped} skipped)" if self.skipped else ""
+        print(f"{self.verb} {self.n} records{skipped} in {wall:.1f}s, {self.n / wall:.0f} rec/s",
+              file=sys.stderr, flush=True)
+
+def file_format(path, fmt):
+    if fmt:
+        return fmt
+    for ext, name in ((".ndjson", "ndjson"), (".jsonl", "ndjson"), (".csv", "csv"), (".parquet", "parquet")):
+        if path.endswith(ext):
+            return name
+    return "ndjson"
+
+def open_text(path, mode):
+    if path == "-":
+        return io.TextIOWrapper((sys.stdout if "w" in mode else sys.stdin).buffer, encoding="utf-8", newline="")
+    return open(path, mode, encoding="utf-8", newline="")
+
+def visit_row(visit, eid=""):
+    return {"id": eid, "created_date": visit["created_date"], "ip_address": visit["ip_address"],
+            "user_agent": visit["user_agent"], "count_after": int(visit["count_after"])}
+
+
+# --- Export ---
+def stream_chunks(start, end, chunk):
+    """Rows from vc:stream between two XRANGE ids, oldest first, `chunk` entries per round trip."""
+    while True:
+        entries = count.r.xrange(count.K_VISITS_STREAM, start, end, count=chunk)
+        if not entries:
+            return
+        ids = [eid.decode() for eid, _ in entries]
+        visits = count.decode_visits([fields[b"r"] for _, fields in entries])
+        yield [visit_row(v, eid) for eid, v in zip(ids, visits)]
+        if len(entries) < chunk:
+            return
+        ms, seq = ids[-1].split("-")
+        start = f"{ms}-{int(seq) + 1}"
+
+def list_chunks(chunk):
+    """Rows from vc:visits, oldest first.
+
+    The list is capped at VISITS_CAP, so it is snapshotted with one LRANGE:
+    paging by index would skip or repeat entries whenever LPUSH + LTRIM
+    shifts the list between reads.
+    """
+    raws = count.r.lrange(count.K_VISITS_LIST, 0, count.VISITS_CAP - 1)
+    visits = count.decode_visits(raws[::-1])
+    for i in range(0, len(visits), chunk):
+        yield [visit_row(v) for v in visits[i:i + chunk]]
+
+def write_text(path, fmt, chunks, progress):
+    with open_text(path, "w") as f:
+        if fmt == "csv":
+            w = csv.DictWriter(f, FIELDS)
+            w.writeheader()
+            for rows in chunks:
+                w.writerows(rows)
+                progress.add(len(rows))
+        else:
+            for rows in chunks:
+                f.write("".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows))
+                progress.add(len(rows))
+
+def write_parquet(path, chunks, progress):
+    pa, pq = require_pyarrow()
+    schema = pa.schema([("id", pa.string()), ("created_date", pa.string()), ("ip_address", pa.string()),
+                        ("user_agent", pa.string()), ("count_after", pa.int64())])
+    with pq.ParquetWriter(path, schema, compression="zstd") as w:
+        for rows in chunks:   # one row group per chunk
+            w.write_table(pa.Table.from_pylist(rows, schema=schema))
+            progress.add(len(rows))
+
+def require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        sys.exit("parquet needs pyarrow: pip install pyarrow")
+    return pyarrow, pyarrow.parquet
+
+def export(args):
+    if args.source == "list":
+        chunks = list_chunks(args.chunk)
+    else:
+        start = "-" if args.start is None else str(count.parse_time_ms(args.start))
+        end = "+" if args.end is None else str(count.parse_time_ms(args.end, end=True))
+        chunks = stream_chunks(start, end, args.chunk)
+    progress = Progress("exported")
+    fmt = file_format(args.path, args.format)
+    if fmt == "parquet":
+        write_parquet(args.path, chunks, progress)
+    else:
+        write_text(args.path, fmt, chunks, progress)
+    progress.done()
+
+
+# --- Import ---
+def read_rows(path, fmt, chunk):
+    """Batches of `chunk` rows from the file, streamed."""
+    if fmt == "parquet":
+        _, pq = require_pyarrow()
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk):
+            yield batch.to_pylist()
+        return
+    with open_text(path, "r") as f:
+        rows = csv.DictReader(f) if fmt == "csv" else (json.loads(line) for line in f if line.strip())
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= chunk:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+def last_stream_id():
+    entries = count.r.xrevrange(count.K_VISITS_STREAM, count=1)
+    return tuple(map(int, entries[0][0].decode().split("-"))) if entries else (0, 0)
+
+def import_batch(script, rows, rollups, after):
+    """Write one batch in a single script call; returns (highest new count_after, skipped)."""
+    keys, args = [count.K_VISIT_COUNT, count.K_VISITS_STREAM, count.K_VISITS_LIST], []
+    skipped = 0
+    for row in rows:
+        doc = {"created_date": row["created_date"], "ip_address": row["ip_address"] or "unknown",
+               "user_agent": (row["user_agent"] or "unknown")[:count.UA_MAX_LEN]}
+        ms = count.ms_from_iso(doc["created_date"])
+        eid = row.get("id") or f"{ms}-*"
+        # An auto id would be accepted again within the last entry's millisecond, so compare the time alone.
+        if ms <= after[0] if eid[-1] == "*" else tuple(map(int, eid.split("-"))) <= after:
+            skipped += 1
+            continue
+        ua_id = count.intern_ua(doc["user_agent"])
+        args += [eid, count.encode_record(doc, ua_id), int(row["count_after"]),
+                 doc["ip_address"], doc["user_agent"], ua_id or "~" + doc["user_agent"]]
+        if rollups:
+            day, hour = doc["created_date"][:10], doc["created_date"][:13]
+            keys += [count.K_DAY + day, count.K_HOUR + hour, count.K_UNIQ_DAY + day, count.K_UNIQ_HOUR + hour,
+                     count.K_TOP_IP + day, count.K_TOP_UA + day]
+    if not args:
+        return 0, skipped
+    written = script(keys=keys, args=[count.VISITS_CAP, int(rollups), count.DAY_TTL, count.HOUR_TTL, count.TOP_K] + args,
+                     client=count.r)
+    return max(written), skipped + written.count(0)
+
+def import_(args):
+    script = count.r.register_script(IMPORT_LUA)
+    after = last_stream_id()
+    progress = Progress("imported")
+    t0 = time.perf_counter()
+    for rows in read_rows(args.path, file_format(args.path, args.format), args.batch):
+        _, skipped = import_batch(script, rows, not args.no_rollups, after)
+        progress.add(len(rows) - skipped, skipped)
+        if args.rate:
+            # Pace batches so the average stays at the target ops/sec.
+            ahead = (progress.n + progress.skipped) / args.rate - (time.perf_counter() - t0)
+            if ahead > 0:
+                time.sleep(ahead)
+    progress.done()
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = p.add_subparsers(dest="cmd", required=True)
+    e = sub.add_parser("export", help="write visits to a file")
+    e.add_argument("path")
+    e.add_argument("--format", choices=["ndjson", "csv", "parquet"])
+    e.add_argument("--source", choices=["stream", "list"], default="stream",
+                   help="vc:stream (full retained history) or vc:visits (recent, capped)")
+    e.add_argument("--from", dest="start", help="stream: epoch ms or ISO 8601, inclusive")
+    e.add_argument("--to", dest="end", help="stream: epoch ms or ISO 8601, inclusive")
+    e.add_argument("--chunk", type=int, default=1000, help="entries per Redis read")
+    i = sub.add_parser("import", help="load visits from a file")
+    i.add_argument("path")
+    i.add_argument("--format", choices=["ndjson", "csv", "parquet"])
+    i.add_argument("--batch", type=int, default=500, help="records per script call")
+    i.add_argument("--rate", type=float, default=0, help="target records/sec (0 = unthrottled)")
+    i.add_argument("--no-rollups", action="store_true", help="don't add to the vc:day / vc:hour counters, vc:uniq:* or vc:top:*")
+    args = p.parse_args()
+    if len(count.SHARDS) > 1:
+        sys.exit("backup.py reads and writes the unsharded key layout only (VC_SHARDS=1)")
+    if args.cmd == "export":
+        export(args)
+    else:
+        import_(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,691 @@
+"""SiteScope benchmarks.
+
+Runs against a local redis-server (REDIS_HOST / REDIS_PORT) or an in-process
+fakeredis with --fake. Benchmarks write to a scratch DB (--db, default 15)
+which is FLUSHED before each run, so never point this at production data.
+
+    python bench.py ingest -n 5000
+    python bench.py ingest --fake
+    python bench.py buffered --threads 32
+    python bench.py encoding
+    python bench.py page --fake
+    python bench.py pages --fake
+    python bench.py guard --fake
+    python bench.py spool -n 2000                  # Redis outage simulation (fakeredis)
+    python bench.py shards --threads 32            # starts redis-server on --port..+3
+    python bench.py shards --shard-urls redis://a:6379/15,redis://b:6379/15
+    python bench.py http --url http://localhost:5002 -c 50 --duration 15
+    python bench.py suite --fake --save baseline.json
+    python bench.py suite --fake --baseline baseline.json   # exits 1 on a regression
+    python bench.py sse --url http://localhost:5002 --clients 100,500,1000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import redis
+
+import count
+
+
+# --- Helpers ---
+def make_client(args):
+    if args.fake:
+        import fakeredis
+        return fakeredis.FakeRedis()
+    host = os.getenv("REDIS_HOST", "localhost")
+    port = int(os.getenv("REDIS_PORT", 6379))
+    return redis.Redis(host=host, port=port, db=args.db)
+
+def use_client(client):
+    """Point count.py (and its single, unsharded shard) at client."""
+    count.r = client
+    count.SHARDS = count.make_shards(1)
+    count._shard_counts = [0]
+
+@contextmanager
+def round_trips(client):
+    """Count network writes (one per command, one per pipeline/script call) and commands.
+
+    Yields [round trips, commands]; a pipeline is one round trip but counts
+    all its commands (MULTI / EXEC included).
+    """
+    cls = client.connection_pool.connection_class
+    orig = cls.send_packed_command, cls.send_command, cls.pack_commands
+    box = [0, 0]
+
+    def counted(self, *a, **kw):
+        box[0] += 1
+        return orig[0](self, *a, **kw)
+
+    def command(self, *a, **kw):
+        box[1] += 1
+        return orig[1](self, *a, **kw)
+
+    def commands(self, cmds):
+        box[1] += len(cmds)
+        return orig[2](self, cmds)
+
+    cls.send_packed_command, cls.send_command, cls.pack_commands = counted, command, commands
+    try:
+        yield box
+    finally:
+        cls.send_packed_command, cls.send_command, cls.pack_commands = orig
+
+def pct(samples, p):
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(round(p / 100.0 * (len(s) - 1))))]
+
+def report(name, n, trips, samples):
+    total = sum(samples)
+    print(f"{name:<24} n={n:<7} rt/visit={trips / n:5.2f}  "
+          f"p50={pct(samples, 50) * 1e3:7.3f}ms  p99={pct(samples, 99) * 1e3:7.3f}ms  "
+          f"ops/s={n / total:9.0f}")
+
+def timed(fn, n):
+    samples = []
+    for i in range(n):
+        t0 = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+# --- Benchmarks ---
+def legacy_create_visit(client, ip, ua):
+    """The original three-round-trip ingest, kept as the comparison baseline."""
+    n = client.incr(count.K_VISIT_COUNT)
+    doc = {"created_date": datetime.utcnow().isoformat() + "Z", "ip_address": ip, "user_agent": ua, "count_after": n}
+    client.lpush(count.K_VISITS_LIST, json.dumps(doc))
+    client.ltrim(count.K_VISITS_LIST, 0, count.VISITS_CAP - 1)
+    return n
+
+def bench_ingest(args):
+    client = make_client(args)
+    use_client(client)
+    ua = "Mozilla/5.0 (bench)"
+    paths = [
+        ("ingest/legacy", lambda i: legacy_create_visit(client, f"10.0.{i % 250}.1", ua)),
+        ("ingest/script", lambda i: count.create_visit(f"10.0.{i % 250}.1", ua)),
+    ]
+    for name, fn in paths:
+        client.flushdb()
+        fn(0)  # warm up: connect, load script
+        with round_trips(client) as trips:
+            samples = timed(fn, args.n)
+        report(name, args.n, trips[0], samples)
+        assert int(client.get(count.K_VISIT_COUNT)) == args.n + 1
+
+def bench_buffered(args):
+    """Concurrent create_visit in sync vs buffered (write-behind) mode."""
+    client = make_client(args)
+    use_client(client)
+    per_thread = max(1, args.n // args.threads)
+    total = per_thread * args.threads
+    for mode in ("sync", "buffered"):
+        client.flushdb()
+        count.INGEST_MODE = mode
+        count._buffer = None
+        results = [[] for _ in range(args.threads)]
+        samples = [[] for _ in range(args.threads)]
+
+        def worker(t):
+            for i in range(per_thread):
+                t0 = time.perf_counter()
+                n, _ = count.create_visit(f"10.{t}.{i % 250}.1", "Mozilla/5.0 (bench)")
+                samples[t].append(time.perf_counter() - t0)
+                results[t].append(n)
+
+        threads = [threading.Thread(target=worker, args=(t,)) for t in range(args.threads)]
+        with round_trips(client) as trips:
+            t0 = time.perf_counter()
+            for th in threads:
+                th.start()
+            for th in threads:
+                th.join()
+            wall = time.perf_counter() - t0
+        flat = [x for s in samples for x in s]
+        print(f"{'ingest/' + mode:<24} n={total:<7} rt/visit={trips[0] / total:5.2f}  "
+              f"p50={pct(flat, 50) * 1e3:7.3f}ms  p99={pct(flat, 99) * 1e3:7.3f}ms  "
+              f"ops/s={total / wall:9.0f}")
+        seen = sorted(x for res in results for x in res)
+        assert seen == list(range(1, total + 1)), "count_after values must be unique and gapless"
+        assert all(res == sorted(res) for res in results), "count_after must be monotonic per caller"
+    count.INGEST_MODE = "sync"
+
+def bench_encoding(args):
+    """Bytes per record, Redis list memory and decode CPU: legacy JSON vs v1 records."""
+    client = make_client(args)
+    use_client(client)
+    client.flushdb()
+    uas = ["Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+           "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148",
+           "curl/8.4.0"]
+    docs = [count.new_doc(f"192.168.{i % 256}.{i % 200}", uas[i % len(uas)]) for i in range(count.VISITS_CAP)]
+    legacy = [json.dumps(dict(d, count_after=i + 1)).encode() for i, d in enumerate(docs)]
+    v1 = [count.encode_record(d, count.intern_ua(d["user_agent"])) + str(i + 1).encode()
+          for i, d in enumerate(docs)]
+    for name, raws in (("legacy-json", legacy), ("v1-binary", v1)):
+        key = f"bench:{name}"
+        client.rpush(key, *raws)
+        try:
+            mem = f"{client.memory_usage(key):>9}"
+        except redis.ResponseError:
+            mem = "      n/a"  # fakeredis has no MEMORY USAGE
+        decode = (lambda xs: [json.loads(x) for x in xs]) if name == "legacy-json" else count.decode_visits
+        samples = timed(lambda _: decode(client.lrange(key, 0, -1)), max(1, args.n // 100))
+        parse = timed(lambda _: decode(raws), max(1, args.n // 100))
+        print(f"{name:<12} bytes/rec={sum(map(len, raws)) / len(raws):6.1f}  list MEMORY USAGE={mem}  "
+              f"lrange+decode p50={pct(samples, 50) * 1e3:6.2f}ms  decode-only p50={pct(parse, 50) * 1e3:6.2f}ms "
+              f"({len(raws)} records)")
+
+def bench_page(args):
+    """A full /api/visits page built in memory vs streamed: time to first byte, total time, peak memory."""
+    client = make_client(args)
+    use_client(client)
+    count.ingest_script = client.register_script(count.INGEST_LUA)
+    count.intern_ua_script = client.register_script(count.INTERN_UA_LUA)
+    count.CACHE_TTL = 0
+    client.flushdb()
+    for i in range(0, count.VISITS_CAP, 100):
+        count.ingest_batch([count.new_doc(f"10.0.{i % 256}.{j}", f"bench/{j % 7}") for j in range(100)])
+    app = count.create_app().test_client()
+    runs = max(1, args.n // 250)
+    for name, threshold, headers in (("buffered", count.VISITS_CAP, {}), ("streamed", 0, {}),
+                                     ("ndjson", 0, {"Accept": count.NDJSON})):
+        count.STREAM_THRESHOLD = threshold
+        first, total, peaks = [], [], []
+        for _ in range(runs):
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            resp = app.get(f"/api/visits?limit={count.VISITS_CAP}", headers=headers, buffered=False)
+            chunks = iter(resp.response)
+            body = next(chunks)
+            while not body:
+                body = next(chunks)
+            first.append(time.perf_counter() - t0)
+            size = len(body) + sum(len(c) for c in chunks)
+            total.append(time.perf_counter() - t0)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            resp.close()
+        print(f"{name:<9} items={count.VISITS_CAP} bytes={size:<7} ttfb p50={pct(first, 50) * 1e3:6.2f}ms  "
+              f"total p50={pct(total, 50) * 1e3:6.2f}ms  peak mem p50={pct(peaks, 50) / 1024:7.0f}KiB")
+
+def bench_pages(args):
+    """Bytes on the wire and server time per HTML page, plus the assets a first visit fetches."""
+    client = make_client(args)
+    use_client(client)
+    count.ingest_script = client.register_script(count.INGEST_LUA)
+    count.intern_ua_script = client.register_script(count.INTERN_UA_LUA)
+    client.flushdb()
+    app = count.create_app().test_client()
+    runs = max(1, args.n // 25)
+    for path in ("/", "/count", "/analytics"):
+        sizes = {}
+        for label, accept in (("identity", "identity"), ("gzip", "gzip"), ("br", "br")):
+            resp = app.get(path, headers={"Accept-Encoding": accept})
+            sizes[label] = len(resp.data) if resp.headers.get("Content-Encoding", "identity") == label else None
+        assets = re.findall(r'"(/assets/[^"]+)"', app.get(path).get_data(as_text=True))
+        first = sum(len(app.get(a, headers={"Accept-Encoding": "gzip, br"}).data) for a in assets)
+        samples = timed(lambda _: app.get(path, headers={"Accept-Encoding": "gzip, br"}), runs)
+        shown = "  ".join(f"{k}={v if v is not None else 'n/a':>6}" for k, v in sizes.items())
+        print(f"{path:<11} {shown}  assets(first visit)={first:>6}  p50={pct(samples, 50) * 1e3:6.3f}ms  "
+              f"p99={pct(samples, 99) * 1e3:6.3f}ms")
+
+def shard_servers(args):
+    """Redis URLs for up to 4 shards, and the redis-server processes started for them."""
+    if args.shard_urls:
+        return args.shard_urls.split(","), []
+    exe = shutil.which("redis-server")
+    if exe is None:
+        raise SystemExit("bench shards needs redis-server on PATH, --shard-urls or --fake")
+    ports = range(args.port, args.port + 4)
+    procs = [subprocess.Popen([exe, "--port", str(p), "--save", "", "--appendonly", "no"],
+                              stdout=subprocess.DEVNULL) for p in ports]
+    for p in ports:
+        client = redis.Redis(port=p)
+        for _ in range(50):
+            try:
+                client.ping()
+                break
+            except redis.ConnectionError:
+                time.sleep(0.1)
+    return [f"redis://localhost:{p}/{args.db}" for p in ports], procs
+
+def bench_shards(args):
+    """Concurrent ingest throughput with the visit data split over 1, 2 and 4 shards, one server each."""
+    if args.fake:
+        import fakeredis
+        urls, procs = None, []
+    else:
+        urls, procs = shard_servers(args)
+    per_thread = max(1, args.n // args.threads)
+    total = per_thread * args.threads
+    try:
+        for n in (1, 2, 4):
+            if urls is None:
+                clients = [fakeredis.FakeRedis(server=fakeredis.FakeServer()) for _ in range(n)]
+                shards = [count.Shard(i, c, f"vc:{{s{i}}}:") for i, c in enumerate(clients)]
+            else:
+                shards = count.make_shards(n, urls[:n])
+                clients = [s.client for s in shards]
+            for c in clients:
+                c.flushdb()
+            use_client(clients[0])   # user agent ids live on the first server
+            count.SHARDS, count._shard_counts = shards, [0] * n
+            samples = [[] for _ in range(args.threads)]
+
+            def worker(t):
+                for i in range(per_thread):
+                    t0 = time.perf_counter()
+                    count.create_visit(f"10.{t}.{i % 250}.{i // 250 % 250}", "Mozilla/5.0 (bench)")
+                    samples[t].append(time.perf_counter() - t0)
+
+            threads = [threading.Thread(target=worker, args=(t,)) for t in range(args.threads)]
+            t0 = time.perf_counter()
+            for th in threads:
+                th.start()
+            for th in threads:
+                th.join()
+            wall = time.perf_counter() - t0
+            counts = [int(s.client.get(s.count) or 0) for s in shards]
+            assert sum(counts) == total, "shard counters must add up to the visits written"
+            flat = [x for s in samples for x in s]
+            print(f"shards={n:<2} n={total:<7} p50={pct(flat, 50) * 1e3:7.3f}ms  p99={pct(flat, 99) * 1e3:7.3f}ms  "
+                  f"ops/s={total / wall:9.0f}  per shard={counts}")
+    finally:
+        for proc in procs:
+            proc.terminate()
+
+def bench_guard(args):
+    """Ingest guard off vs on for unique visitors, refresh storms and a bot rotating user agents."""
+    client = make_client(args)
+    use_client(client)
+    hits = [(f"10.0.{i // 250}.{i % 250}", "Mozilla/5.0") for i in range(200)]       # one hit each
+    hits += [(f"10.1.0.{i}", "Mozilla/5.0 (refresh)") for i in range(20) for _ in range(20)]
+    hits += [(f"10.2.0.{i}", f"bot/{j}") for i in range(3) for j in range(300)]       # defeats dedupe
+    random.Random(1).shuffle(hits)
+    for name, rate, burst, window in (("off", 0, 0, 0), ("on", 1.0, 20, 30)):
+        client.flushdb()
+        count.GUARD_RATE, count.GUARD_BURST, count.DEDUPE_WINDOW = rate, burst, window
+        count.guard = count.IngestGuard(rate, burst, window, count.GUARD_LOCAL_MAX) if rate or window else None
+        dropped = deduped = 0
+
+        def hit(i):
+            nonlocal dropped, deduped
+            try:
+                deduped += bool(count.create_visit(*hits[i])[1].get("deduped"))
+            except count.RateLimited:
+                dropped += 1
+
+        with round_trips(client) as ops:
+            samples = timed(hit, len(hits))
+        counted = int(client.get(count.K_VISIT_COUNT) or 0)
+        print(f"guard={name:<4} hits={len(hits):<6} counted={counted:<6} deduped={deduped:<6} dropped={dropped:<6} "
+              f"rt/hit={ops[0] / len(hits):5.2f}  p50={pct(samples, 50) * 1e3:6.3f}ms  "
+              f"p99={pct(samples, 99) * 1e3:6.3f}ms  {count.guard.stats() if count.guard else ''}")
+    count.guard = None
+
+def bench_spool(args):
+    """Redis outage simulation: visits go to the local spool, then are replayed exactly once.
+
+    A dead worker's spool file (ending in a line cut short by the crash) is
+    replayed along with this worker's, by several replayers at once.
+    """
+    import fakeredis
+    server = fakeredis.FakeServer()
+    client = fakeredis.FakeRedis(server=server)
+    use_client(client)
+    client.flushdb()
+    before = 100
+    for i in range(before):
+        count.create_visit(f"10.0.0.{i % 250}", "Mozilla/5.0 (bench)")
+    with tempfile.TemporaryDirectory() as d:
+        count.SPOOL_DIR, count.SPOOL_REPLAY_INTERVAL, count._spool = d, 3600, None   # replayed by hand below
+        spool = count.get_spool()
+        dead = [json.dumps(count.new_doc(f"10.9.0.{i}", "dead/1.0")) + "\n" for i in range(3)]
+        with open(os.path.join(d, "0-1-1.spool"), "w") as f:
+            f.write("".join(dead) + '{"created_date":"20')
+        os.utime(os.path.join(d, "0-1-1.spool"), (0, 0))
+
+        server.connected = False
+        docs = []
+        samples = timed(lambda i: docs.append(count.create_visit(f"10.1.{i // 250 % 250}.{i % 250}",
+                                                                 "Mozilla/5.0 (bench)")[1]), args.n)
+        report("spool/append (down)", args.n, 0, samples)
+        spool.sync()
+        server.connected = True
+
+        t0 = time.perf_counter()
+        done = [0] * 4
+
+        def replayer(t):
+            done[t] = spool.replay()
+
+        threads = [threading.Thread(target=replayer, args=(t,)) for t in range(len(done))]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        wall = time.perf_counter() - t0
+        print(f"{'spool/replay':<24} n={sum(done):<7} replayers={len(done)}  per replayer={done}  "
+              f"ops/s={sum(done) / wall:9.0f}  files left={os.listdir(d)}")
+        assert spool.replay() == 0, "a second replay must not write anything"
+        spool.close()
+        count.SPOOL_DIR, count._spool = "", None
+
+    total = before + args.n + len(dead)
+    entries = client.xrange(count.K_VISITS_STREAM)
+    visits = count.decode_visits([fields[b"r"] for _, fields in entries])
+    assert int(client.get(count.K_VISIT_COUNT)) == total == len(visits), "every visit exactly once"
+    assert sorted(v["count_after"] for v in visits) == list(range(1, total + 1)), "count_after gapless"
+    replayed = {(v["created_date"], v["ip_address"]): v["count_after"] for v in visits}
+    ours = [replayed[(d["created_date"], d["ip_address"])] for d in docs]
+    assert ours == sorted(ours), "spooled visits replayed in arrival order"
+    print(f"ok: {total} visits, count_after 1..{total}, {args.n} spooled visits in order")
+
+# --- HTTP load (against a running server, e.g. --url http://localhost:5002) ---
+async def read_response(reader):
+    status = await reader.readline()
+    if not status:
+        raise ConnectionError("server closed the connection")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        k, _, v = line.decode("latin-1").partition(":")
+        headers[k.strip().lower()] = v.strip()
+    if "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    elif headers.get("transfer-encoding") == "chunked":
+        parts = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            parts.append(await reader.readexactly(size + 2))
+            if size == 0:
+                break
+        body = b"".join(p[:-2] for p in parts)
+    else:
+        body = await reader.read()
+    return int(status.split()[1]), headers, body
+
+async def http_request(host, port, method, path):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Length: 0\r\n"
+                 f"Connection: close\r\n\r\n".encode())
+    await writer.drain()
+    _, _, body = await read_response(reader)
+    writer.close()
+    return body
+
+HTTP_MIX = "/count=1,/api/incr=1,/api/summary=4,/api/analytics=1"
+
+def parse_mix(spec):
+    """"/count=1,/api/visits?limit=999=4" -> [(path, weight), ...]; the weight follows the last "="."""
+    mix = []
+    for part in spec.split(","):
+        path, _, w = part.rpartition("=")
+        mix.append((path, float(w)) if path else (w, 1.0))
+    return mix
+
+async def http_worker(host, port, mix, deadline, rng, samples, stats):
+    paths = [p for p, _ in mix]
+    weights = [w for _, w in mix]
+    conn = None
+    while time.perf_counter() < deadline:
+        path = rng.choices(paths, weights)[0]
+        try:
+            if conn is None:
+                conn = await asyncio.open_connection(host, port)
+            reader, writer = conn
+            t0 = time.perf_counter()
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+            await writer.drain()
+            status, headers, _ = await read_response(reader)
+            samples[path].append(time.perf_counter() - t0)
+            if status >= 400:
+                stats["errors"] += 1
+            if headers.get("connection", "").lower() == "close":
+                writer.close()
+                conn = None
+        except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+            stats["errors"] += 1
+            conn = None
+    if conn is not None:
+        conn[1].close()
+
+async def http_round(host, port, mix, concurrency, duration, seed=1):
+    samples = defaultdict(list)
+    stats = {"errors": 0}
+    deadline = time.perf_counter() + duration
+    t0 = time.perf_counter()
+    await asyncio.gather(*(http_worker(host, port, mix, deadline, random.Random(seed + i), samples, stats)
+                           for i in range(concurrency)))
+    return samples, stats, time.perf_counter() - t0
+
+def bench_http(args):
+    """Closed-loop HTTP load: `concurrency` keep-alive clients for `duration` seconds."""
+    u = urlsplit(args.url)
+    for c in (int(x) for x in str(args.concurrency).split(",")):
+        samples, stats, wall = asyncio.run(http_round(u.hostname, u.port or 80, parse_mix(args.mix or HTTP_MIX),
+                                                      c, args.duration))
+        flat = [x for s in samples.values() for x in s] or [0.0]
+        print(f"http c={c:<5} req={len(flat):<8} errors={stats['errors']:<6} "
+              f"rps={len(flat) / wall:8.0f}  p50={pct(flat, 50) * 1e3:7.2f}ms  "
+              f"p95={pct(flat, 95) * 1e3:7.2f}ms  p99={pct(flat, 99) * 1e3:7.2f}ms")
+        for path, xs in sorted(samples.items()):
+            print(f"  {path:<28} n={len(xs):<8} p50={pct(xs, 50) * 1e3:7.2f}ms  p99={pct(xs, 99) * 1e3:7.2f}ms")
+
+async def sse_client(host, port, received, stats, ready):
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(f"GET /api/stream HTTP/1.1\r\nHost: {host}\r\n"
+                     f"Accept: text/event-stream\r\n\r\n".encode())
+        await writer.drain()
+        status = await reader.readline()
+    except OSError:
+        stats["failed"] += 1
+        ready()
+        return
+    if b" 200 " not in status:
+        stats["rejected"] += 1
+        ready()
+        return
+    stats["connected"] += 1
+    ready()
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        if line.startswith(b"id: "):
+            received[int(line[4:])].append(time.perf_counter())
+
+async def sse_round(host, port, n_clients, n_events, interval):
+    stats = {"connected": 0, "rejected": 0, "failed": 0}
+    received = defaultdict(list)
+    pending = [n_clients]
+    all_ready = asyncio.Event()
+
+    def ready():
+        pending[0] -= 1
+        if pending[0] == 0:
+            all_ready.set()
+
+    tasks = [asyncio.ensure_future(sse_client(host, port, received, stats, ready)) for _ in range(n_clients)]
+    await asyncio.wait_for(all_ready.wait(), timeout=60)
+    await asyncio.sleep(0.5)
+    sent = {}
+    for _ in range(n_events):
+        t0 = time.perf_counter()
+        body = await http_request(host, port, "POST", "/api/incr")
+        sent[json.loads(body)["count"]] = t0
+        await asyncio.sleep(interval)
+    await asyncio.sleep(2)
+    for t in tasks:
+        t.cancel()
+    lat = [t - sent[cid] for cid, ts in received.items() if cid in sent for t in ts]
+    expected = stats["connected"] * n_events
+    print(f"sse clients={n_clients:<6} connected={stats['connected']:<6} rejected={stats['rejected']:<5} "
+          f"failed={stats['failed']:<5} delivered={len(lat)}/{expected}  "
+          + (f"p50={pct(lat, 50) * 1e3:7.1f}ms  p99={pct(lat, 99) * 1e3:7.1f}ms" if lat else ""))
+
+def bench_sse(args):
+    """How many /api/stream subscribers one server holds, and fan-out latency."""
+    u = urlsplit(args.url)
+    for n in (int(x) for x in args.clients.split(",")):
+        asyncio.run(sse_round(u.hostname, u.port or 80, n, args.events, 0.2))
+
+
+# --- Suite: microbenchmarks + in-process HTTP mix, checked against a baseline ---
+SUITE_MIX = "/count=1,/api/incr=2,/api/visits?limit=999=1,/api/analytics=1"
+GATED = {"p50_ms": -1, "ops_s": 1, "rps": 1, "rt_req": -1, "cmds_req": -1}   # +1: higher is better
+
+@contextmanager
+def serve(app):
+    """Run app on a threaded werkzeug server on a free local port; yields the port."""
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)   # no access log lines in the report
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server.server_port
+    finally:
+        server.shutdown()
+
+def micro(name, fn, n, results):
+    timed(fn, min(n, 20))   # warm up: connections, scripts, caches
+    samples = timed(fn, n)
+    results[name] = {"p50_ms": pct(samples, 50) * 1e3, "p99_ms": pct(samples, 99) * 1e3, "ops_s": n / sum(samples)}
+
+def suite_micro(args, client, results):
+    count.CACHE_TTL = 0
+    n = max(10, args.n // 10)
+    micro("micro/create_visit", lambda i: count.create_visit(f"10.0.{i % 250}.1", "Mozilla/5.0 (bench)"), n, results)
+    for limit in (100, 999):
+        micro(f"micro/list_visits({limit})", lambda _: count.list_visits(limit), n, results)
+    micro("micro/build_analytics", lambda _: count.build_analytics(), n, results)
+    pipe = client.pipeline(transaction=False)
+    labels = count.analytics_commands(pipe)
+    fetched = pipe.execute()
+    micro("micro/analytics_result", lambda _: count.analytics_result(labels, fetched), n * 10, results)
+    count.CACHE_TTL = float(os.getenv("VC_CACHE_TTL_MS", 2000)) / 1000
+
+def suite_http(args, client, results):
+    mix = parse_mix(args.mix or SUITE_MIX)
+    with serve(count.create_app()) as port:
+        for c in (int(x) for x in str(args.concurrency).split(",")):
+            with round_trips(client) as ops:
+                samples, stats, wall = asyncio.run(http_round("127.0.0.1", port, mix, c, args.duration))
+            flat = [x for s in samples.values() for x in s] or [0.0]
+            results[f"http/c={c}"] = {
+                "rps": len(flat) / wall, "p50_ms": pct(flat, 50) * 1e3, "p95_ms": pct(flat, 95) * 1e3,
+                "p99_ms": pct(flat, 99) * 1e3, "rt_req": ops[0] / len(flat), "cmds_req": ops[1] / len(flat),
+                "errors": stats["errors"]}
+            for path, xs in sorted(samples.items()):
+                results[f"http/c={c} {path}"] = {"p50_ms": pct(xs, 50) * 1e3, "p99_ms": pct(xs, 99) * 1e3,
+                                                 "requests": len(xs)}
+
+def compare(results, baseline, tolerance):
+    """Print results next to the baseline; returns the gated metrics that got worse by more than tolerance."""
+    regressions = []
+    for name, vals in results.items():
+        base = baseline.get(name, {})
+        cells = []
+        for k, v in vals.items():
+            cell = f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}"
+            b = base.get(k)
+            if b:
+                change = (v - b) / b
+                cell += f" ({change:+.0%})"
+                # Per-path rows (name with a path) are too noisy under a shared GIL to gate.
+                if k in GATED and " " not in name and change * GATED[k] < -tolerance:
+                    regressions.append(f"{name} {k}: {b:.3f} -> {v:.3f} ({change:+.0%})")
+                    cell += " !"
+            cells.append(cell)
+        print(f"{name:<40} " + "  ".join(cells))
+    return regressions
+
+def bench_suite(args):
+    """Microbenchmarks and an HTTP mix against an in-process server, one report, optional baseline gate.
+
+    --save writes the results as the new baseline; --baseline compares with
+    one and exits non-zero when a gated metric (p50, throughput, Redis round
+    trips or commands per request) is worse by more than --tolerance.
+    Baselines are only comparable on the same machine and Redis backend.
+    """
+    client = make_client(args)
+    use_client(client)
+    count.ingest_script = client.register_script(count.INGEST_LUA)
+    count.intern_ua_script = client.register_script(count.INTERN_UA_LUA)
+    client.flushdb()
+    for i in range(0, count.VISITS_CAP, 100):   # a full visit list and a day of rollups to read
+        count.ingest_batch([count.new_doc(f"10.0.{i % 256}.{j}", f"bench/{j % 7}") for j in range(100)])
+    results = {}
+    suite_micro(args, client, results)
+    suite_http(args, client, results)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"redis": "fakeredis" if args.fake else "redis-server", "saved": datetime.utcnow().isoformat(),
+                       "results": results}, f, indent=2)
+    if regressions:
+        raise SystemExit("regressions against " + args.baseline + ":\n  " + "\n  ".join(regressions))
+
+BENCHMARKS = {
+    "ingest": bench_ingest,
+    "buffered": bench_buffered,
+    "encoding": bench_encoding,
+    "page": bench_page,
+    "pages": bench_pages,
+    "shards": bench_shards,
+    "spool": bench_spool,
+    "guard": bench_guard,
+    "sse": bench_sse,
+    "http": bench_http,
+    "suite": bench_suite,
+}
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("bench", choices=sorted(BENCHMARKS))
+    p.add_argument("-n", type=int, default=5000, help="operations per path")
+    p.add_argument("--threads", type=int, default=16, help="concurrent callers")
+    p.add_argument("--url", default="http://localhost:5002", help="server for HTTP benchmarks")
+    p.add_argument("-c", "--concurrency", default="50", help="http: concurrent clients, e.g. 100,1000")
+    p.add_argument("--duration", type=float, default=10, help="http: seconds per run")
+    p.add_argument("--mix", help=f"http/suite: weighted path mix (http: {HTTP_MIX}; suite: {SUITE_MIX})")
+    p.add_argument("--clients", default="100,500,1000", help="sse: subscriber counts to try")
+    p.add_argument("--events", type=int, default=20, help="sse: visits to fan out per round")
+    p.add_argument("--shard-urls", help="shards: comma-separated redis:// URLs to use instead of starting servers")
+    p.add_argument("--port", type=int, default=7001, help="shards: first port for the started redis-servers")
+    p.add_argument("--save", help="suite: write the results to this baseline file")
+    p.add_argument("--baseline", help="suite: compare with this baseline file, exit 1 on regression")
+    p.add_argument("--tolerance", type=float, default=0.2, help="suite: allowed relative slowdown (0.2 = 20%%)")
+    p.add_argument("--db", type=int, default=15, help="scratch redis DB (flushed)")
+    p.add_argument("--fake", action="store_true", help="use in-process fakeredis")
+    args = p.parse_args()
+    BENCHMARKS[args.bench](args)
+
+if __name__ == "__main__":
+    main()
@@ -1,106 +1,1692 @@
 import os
+import gzip
+import hashlib
 import json
-from datetime import datetime, timedelta
-from flask import Flask, jsonify, render_template_string, request
+import queue
+import socket
+import struct
+import threading
+import time
+import zlib
+from contextlib import nullcontext, suppress
+from datetime import datetime, timedelta, timezone
+from flask import Blueprint, Flask, Response, abort, jsonify, request
+from jinja2 import Environment
 import redis
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+try:
+    import brotli   # optional: pip install brotli
+except ImportError:
+    brotli = None
+try:
+    import prometheus_client   # optional: pip install prometheus_client
+except ImportError:
+    prometheus_client = None
 
 APP_NAME = "SiteScope"
 
 # --- Flask & Redis ---
-app = Flask(__name__)
-redis_host = os.getenv("REDIS_HOST", "redis")
-redis_port = int(os.getenv("REDIS_PORT", 6379))
-r = redis.Redis(host=redis_host, port=redis_port, decode_responses=True)
+bp = Blueprint("sitescope", __name__)
+
+def redis_options():
+    """Pool and socket settings from env, shared by the sync and async clients."""
+    return dict(
+        host=os.getenv("REDIS_HOST", "redis"),
+        port=int(os.getenv("REDIS_PORT", 6379)),
+        max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", 50)),
+        timeout=float(os.getenv("REDIS_POOL_TIMEOUT", 2)),          # wait for a free pooled connection
+        socket_connect_timeout=float(os.getenv("REDIS_CONNECT_TIMEOUT", 1)),
+        socket_timeout=float(os.getenv("REDIS_SOCKET_TIMEOUT", 2)),
+        health_check_interval=int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30)),
+        retry_on_error=[redis.ConnectionError, redis.TimeoutError],
+        decode_responses=False,   # vc:visits holds binary records; callers decode what they read
+    )
+
+REDIS_RETRIES = int(os.getenv("REDIS_RETRIES", 3))
+REDIS_BACKOFF_BASE = float(os.getenv("REDIS_BACKOFF_BASE_MS", 50)) / 1000
+REDIS_BACKOFF_CAP = float(os.getenv("REDIS_BACKOFF_CAP_MS", 1000)) / 1000
+BREAKER_THRESHOLD = int(os.getenv("REDIS_BREAKER_THRESHOLD", 5))      # consecutive failures
+BREAKER_COOLDOWN = float(os.getenv("REDIS_BREAKER_COOLDOWN_S", 5))
+
+class CircuitOpen(redis.ConnectionError):
+    pass
+
+class CircuitBreaker:
+    """Fail fast while Redis is down.
+
+    After `threshold` consecutive connection/timeout failures every call raises
+    CircuitOpen for `cooldown` seconds; then a single probe call is let
+    through and its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.failures < self.threshold:
+            return "closed"
+        return "half-open" if time.monotonic() >= self.open_until else "open"
+
+    def call(self, fn, *args, **kwargs):
+        with self.lock:
+            if self.failures >= self.threshold:
+                if time.monotonic() < self.open_until or self.probing:
+                    raise CircuitOpen("redis circuit open")
+                self.probing = True
+        try:
+            result = fn(*args, **kwargs)
+        except (redis.ConnectionError, redis.TimeoutError):
+            with self.lock:
+                self.probing = False
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.open_until = time.monotonic() + self.cooldown
+            raise
+        if self.failures:
+            with self.lock:
+                self.failures = 0
+                self.probing = False
+        return result
+
+breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+
+class GuardedRedis(redis.Redis):
+    """redis.Redis whose commands and pipelines go through the circuit breaker.
+
+    With metrics on, every command and pipeline is also timed.
+    """
+
+    def execute_command(self, *args, **options):
+        if metrics is None:
+            return breaker.call(super().execute_command, *args, **options)
+        with metrics.redis_seconds.labels(str(args[0]).upper()).time():
+            return breaker.call(super().execute_command, *args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super().pipeline(transaction, shard_hint)
+        execute = pipe.execute
+        if metrics is None:
+            pipe.execute = lambda raise_on_error=True: breaker.call(execute, raise_on_error)
+            return pipe
+        timer = metrics.redis_seconds.labels("MULTI" if transaction else "PIPELINE")
+
+        def timed_execute(raise_on_error=True):
+            with timer.time():
+                return breaker.call(execute, raise_on_error)
+        pipe.execute = timed_execute
+        return pipe
+
+def make_pool(url=None):
+    retry = Retry(ExponentialBackoff(cap=REDIS_BACKOFF_CAP, base=REDIS_BACKOFF_BASE), REDIS_RETRIES)
+    if url is None:
+        return redis.BlockingConnectionPool(retry=retry, **redis_options())
+    opts = {k: v for k, v in redis_options().items() if k not in ("host", "port")}
+    return redis.BlockingConnectionPool.from_url(url, retry=retry, **opts)
+
+pool = make_pool()
+r = GuardedRedis(connection_pool=pool)
+
+def pool_stats(p=None):
+    """Connection pool utilization, read from redis-py pool internals (best effort)."""
+    p = p or pool
+    if hasattr(p, "_in_use_connections"):   # asyncio pools
+        in_use, idle = len(p._in_use_connections), len(p._available_connections)
+    else:                                   # sync BlockingConnectionPool: a queue padded with None
+        idle = sum(1 for c in list(p.pool.queue) if c is not None)
+        in_use = len(p._connections) - idle
+    return {"max": p.max_connections, "created": in_use + idle, "in_use": in_use, "idle": idle}
+
+# --- Metrics ---
+# Prometheus metrics, on with VC_METRICS=1 when prometheus_client is installed.
+# Under gunicorn, PROMETHEUS_MULTIPROC_DIR makes every worker write its
+# samples to that directory and /metrics aggregates them (see gunicorn.conf.py).
+# Off, the hot paths only test `metrics is None`.
+FAST_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+
+class Metrics:
+    def __init__(self, pc):
+        self.pc = pc
+        H, C, G = pc.Histogram, pc.Counter, pc.Gauge
+        self.request_seconds = H("vc_http_request_duration_seconds",
+                                 "Time to response headers, per route", ["route", "method"])
+        self.requests = C("vc_http_requests_total", "Responses, per route and status", ["route", "status"])
+        self.response_bytes = H("vc_http_response_size_bytes", "Response body size (unstreamed responses)",
+                                ["route"], buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576))
+        self.redis_seconds = H("vc_redis_command_duration_seconds",
+                               "Redis round trip, per command (MULTI / PIPELINE for pipelines)",
+                               ["command"], buckets=FAST_BUCKETS)
+        self.ingested = C("vc_visits_ingested_total", "Visits written to Redis")
+        self.ingest_batch = H("vc_ingest_batch_size", "Visits per ingest script call",
+                              buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+        self.ingest_errors = C("vc_ingest_errors_total", "Ingest script calls that failed")
+        self.spooled = C("vc_visits_spooled_total", "Visits written to the local spool while Redis was down")
+        self.replayed = C("vc_visits_replayed_total", "Spooled visits replayed into Redis")
+        self.guard = C("vc_ingest_guard_total", "Visits turned away by the ingest guard",
+                       ["result", "where"])
+        self.cache = C("vc_response_cache_total", "Response cache lookups", ["result"])
+        self.analytics_seconds = H("vc_analytics_phase_seconds", "/api/analytics time per phase",
+                                   ["phase"], buckets=FAST_BUCKETS)
+        self.pool = G("vc_redis_pool_connections", "Redis pool connections", ["state"],
+                      multiprocess_mode="livesum")
+        self.breaker_open = G("vc_redis_circuit_open", "1 while the Redis circuit breaker is open",
+                              multiprocess_mode="livemax")
+
+    def render(self):
+        """(body, content type) of the current samples, from all workers in multiprocess mode."""
+        pc = self.pc
+        registry = pc.REGISTRY
+        if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+            from prometheus_client import multiprocess
+            registry = pc.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        return pc.generate_latest(registry), pc.CONTENT_TYPE_LATEST
+
+metrics = Metrics(prometheus_client) if os.getenv("VC_METRICS") == "1" and prometheus_client else None
+
+def timed(hist, *labels):
+    """Context manager observing the block's duration into hist (no-op with metrics off)."""
+    return getattr(metrics, hist).labels(*labels).time() if metrics is not None else nullcontext()
 
 # --- Keys ---
 K_VISIT_COUNT = "vc:count"     # integer
-K_VISITS_LIST = "vc:visits"    # list of JSON docs (newest first)
+K_VISITS_LIST = "vc:visits"    # list of encoded visit records (newest first)
+VISITS_CAP = 1000              # max docs kept in K_VISITS_LIST
+CH_VISITS = "vc:events"        # pub/sub channel, one message per ingested batch
+K_DAY = "vc:day:"              # + YYYY-MM-DD    -> visits that UTC day
+K_HOUR = "vc:hour:"            # + YYYY-MM-DDTHH -> visits that UTC hour
+DAY_TTL = int(os.getenv("VC_DAY_TTL_DAYS", 90)) * 86400
+HOUR_TTL = int(os.getenv("VC_HOUR_TTL_HOURS", 192)) * 3600
+ANALYTICS_MAX_DAYS = DAY_TTL // 86400   # older day rollups have expired
+K_UNIQ_DAY = "vc:uniq:day:"    # + YYYY-MM-DD    -> HyperLogLog of "ip|user agent" (~12 KB max)
+K_UNIQ_HOUR = "vc:uniq:hour:"  # + YYYY-MM-DDTHH -> same, per hour
+K_TOP_IP = "vc:top:ip:"        # + YYYY-MM-DD -> zset ip -> visits, at most TOP_K members
+K_TOP_UA = "vc:top:ua:"        # + YYYY-MM-DD -> zset user agent id -> visits, same
+TOP_K = int(os.getenv("VC_TOP_K", 100))   # tracked per day; counts are exact while fewer are seen
+TOP_N = 10                     # reported by /api/analytics
+K_VISITS_STREAM = "vc:stream"  # stream of the same records, entry id = ingest time (ms)
+RETENTION_MS = int(os.getenv("VC_RETENTION_DAYS", 30)) * 86400 * 1000   # trimmed by age (MINID)
+RANGE_MAX = 1000               # max entries per /api/visits?from=&to= page
+K_UA_IDS = "vc:ua:ids"         # hash: user agent -> id
+K_UA_NAMES = "vc:ua:names"     # hash: id -> user agent
+K_UA_SEQ = "vc:ua:seq"         # last assigned user agent id
+
+# --- Shards ---
+# VC_SHARDS=N splits the visit data (counter, list, stream, rollups, sketches)
+# into N shards so writes spread over keys, cluster slots and, with
+# REDIS_SHARD_URLS (comma-separated redis:// URLs, shard i on URL i mod len),
+# over several Redis servers. A visit goes to the shard of its IP
+# (VC_SHARD_BY=ip: a visitor always hits the same shard, so per-shard unique
+# counts add up) or of the worker process (VC_SHARD_BY=worker). Reads merge
+# the shards; the total is the sum of the shard counters, cached for
+# VC_TOTAL_CACHE_MS. count_after is then an estimate: the shard's own count
+# plus the other shards' last known counts, so workers can hand out the same
+# value twice and it is no cursor. Sharded, ?since= is refused, SSE events
+# carry no id and are not replayed on reconnect; page history with the
+# per-shard from/to/cursor range instead. User agent ids stay on `r`.
+SHARDS_N = max(1, int(os.getenv("VC_SHARDS", 1)))
+SHARD_BY = os.getenv("VC_SHARD_BY", "ip")
+SHARD_URLS = [u for u in os.getenv("REDIS_SHARD_URLS", "").split(",") if u]
+TOTAL_TTL = float(os.getenv("VC_TOTAL_CACHE_MS", 1000)) / 1000
+
+class Shard:
+    """Key names and Redis client of one shard.
+
+    The single unsharded shard uses the plain vc:* keys. Shard i of N uses
+    vc:{s<i>}:*: the hash tag puts every key one ingest call touches in one
+    cluster slot, and different shards in different slots.
+    """
+
+    def __init__(self, index, client, prefix):
+        self.index = index
+        self.client = client
+        self.count = prefix + "count"
+        self.visits = prefix + "visits"
+        self.stream = prefix + "stream"
+        self.day = prefix + "day:"
+        self.hour = prefix + "hour:"
+        self.uniq_day = prefix + "uniq:day:"
+        self.uniq_hour = prefix + "uniq:hour:"
+        self.top_ip = prefix + "top:ip:"
+        self.top_ua = prefix + "top:ua:"
+        self.spool = prefix + "spool:"
+        self.bucket = prefix + "rate:"   # + ip -> token bucket hash
+        self.seen = prefix + "seen:"     # + hash of ip|user agent -> dedupe marker
+        self.ingested = prefix + "ingest:"   # + call token -> count after that ingest call
+
+def make_shards(n, urls=()):
+    if n == 1 and not urls:
+        return [Shard(0, r, "vc:")]
+    clients = [GuardedRedis(connection_pool=make_pool(u)) for u in urls] or [r]
+    return [Shard(i, clients[i % len(clients)], f"vc:{{s{i}}}:") for i in range(n)]
+
+SHARDS = make_shards(SHARDS_N, SHARD_URLS)
+
+def shard_for(ip):
+    if len(SHARDS) == 1:
+        return SHARDS[0]
+    key = os.getpid() if SHARD_BY == "worker" else zlib.crc32(ip.encode())
+    return SHARDS[key % len(SHARDS)]
+
+def by_client(shards=None):
+    """Shards grouped by Redis client, for one pipeline per server."""
+    groups = {}
+    for s in shards or SHARDS:
+        groups.setdefault(id(s.client), []).append(s)
+    return list(groups.values())
+
+# --- Visit encoding ---
+# v1 record: version byte, ts ms (u64), user agent id (u32), ip kind, ip length,
+# ip bytes (4 / 16 packed, or the raw string for kind 0), then count_after as
+# ASCII digits appended by the ingest script. User agent id 0 means the user
+# agent was not interned and follows the ip inline (u16 length, UTF-8 bytes).
+# Entries starting with "{" are legacy JSON docs and are still decoded.
+REC_V1 = 1
+_REC_HEAD = struct.Struct(">BQIBB")
+_UA_LEN = struct.Struct(">H")
+_IP_FAMILY = {4: socket.AF_INET, 6: socket.AF_INET6}
+UA_MAX_LEN = 512
+UA_CACHE_MAX = 10000           # per-worker interned user agents kept in memory
+# Ids handed out in vc:ua:ids / vc:ua:names before new user agents are stored
+# inline instead; the dictionary never grows past this.
+UA_DICT_MAX = int(os.getenv("VC_UA_DICT_MAX", 100000))
+
+# --- Ingest mode ---
+# "sync": each hit runs the ingest script itself.
+# "buffered": hits are queued in process and a flusher thread writes them in
+# batches (group commit); callers still wait for their exact count_after.
+INGEST_MODE = os.getenv("VC_INGEST_MODE", "sync")
+BUFFER_MAX_BATCH = int(os.getenv("VC_BUFFER_MAX_BATCH", 256))
+BUFFER_MAX_DELAY = float(os.getenv("VC_BUFFER_MAX_DELAY_MS", 5)) / 1000
+BUFFER_MAX_QUEUE = int(os.getenv("VC_BUFFER_MAX_QUEUE", 10000))
+BUFFER_FULL = os.getenv("VC_BUFFER_FULL", "block")   # block | sync | reject
+BUFFER_BLOCK_TIMEOUT = float(os.getenv("VC_BUFFER_BLOCK_MS", 1000)) / 1000
+# Every ingest call leaves a marker (its count) for VC_INGEST_MARK_S seconds.
+# A call re-sent after a timeout (redis-py retries, or the spool replaying
+# visits whose call timed out) finds it and writes nothing twice. Costs one
+# small key per call; a spooled call must be replayed within this window.
+INGEST_MARK_TTL = int(os.getenv("VC_INGEST_MARK_S", 3600))
+
+# --- Ingest guard ---
+# Per-IP token bucket (VC_RATE_PER_S refill, VC_RATE_BURST capacity) and an
+# (IP, user agent) dedupe window of VC_DEDUPE_S seconds, checked inside the
+# ingest script; 0 turns either off. Rate-limited hits get a 429, repeats
+# within the window are served the current count without counting again.
+GUARD_RATE = float(os.getenv("VC_RATE_PER_S", 0))
+GUARD_BURST = int(os.getenv("VC_RATE_BURST", 20))
+DEDUPE_WINDOW = int(os.getenv("VC_DEDUPE_S", 0))
+GUARD_LOCAL_MAX = 10000   # per-worker pre-filter entries before it is reset
+# The bucket and dedupe keys live in the visitor's shard, next to the write
+# they gate (one script call, one cluster slot). That is only one bucket per
+# IP when an IP always maps to the same shard, so the guard needs
+# VC_SHARD_BY=ip: sharded by worker, each shard would grant the full rate.
+if (GUARD_RATE > 0 or DEDUPE_WINDOW > 0) and SHARDS_N > 1 and SHARD_BY == "worker":
+    raise RuntimeError("VC_RATE_PER_S / VC_DEDUPE_S need VC_SHARD_BY=ip when VC_SHARDS > 1")
+# Visits are keyed on request.remote_addr. Behind NGINX that is the proxy, so
+# ProxyFix takes the client address from the last VC_PROXY_HOPS entries of
+# X-Forwarded-For (the ones our own proxies appended); anything a client
+# put there itself is ignored. Set 0 when nothing sits in front of the app.
+PROXY_HOPS = int(os.getenv("VC_PROXY_HOPS", 1))
+
+# --- Fallback spool ---
+# With VC_SPOOL_DIR set, visits that cannot be written because Redis is
+# unreachable are appended to local files there instead of failing the
+# request, and replayed into Redis once it is back. Files are fsynced every
+# VC_SPOOL_FSYNC_MS, so a crash loses at most that window of spooled visits.
+SPOOL_DIR = os.getenv("VC_SPOOL_DIR", "")
+SPOOL_FSYNC = float(os.getenv("VC_SPOOL_FSYNC_MS", 50)) / 1000
+SPOOL_BATCH = int(os.getenv("VC_SPOOL_BATCH", 500))           # visits per replay script call
+SPOOL_REPLAY_INTERVAL = float(os.getenv("VC_SPOOL_REPLAY_S", 1))
+SPOOL_IDLE = 300          # s; another worker's drained file is removed once untouched this long
+SPOOL_KEY_TTL = 7 * 86400
+
+# --- Response cache ---
+# Per-worker cache of serialized JSON bodies for the read endpoints. Entries
+# live CACHE_TTL seconds and are dropped whenever this worker ingests a visit;
+# other workers converge within CACHE_TTL. 0 disables caching.
+CACHE_TTL = float(os.getenv("VC_CACHE_TTL_MS", 2000)) / 1000
+CACHE_MAX_ENTRIES = 1024
+
+# --- Streaming responses ---
+# /api/visits pages above STREAM_THRESHOLD items (or any page requested as
+# NDJSON) are written out as they are read, STREAM_CHUNK list entries per
+# round trip, instead of being built and serialized in memory first.
+STREAM_THRESHOLD = int(os.getenv("VC_STREAM_THRESHOLD", 200))
+STREAM_CHUNK = int(os.getenv("VC_STREAM_CHUNK", 200))
+NDJSON = "application/x-ndjson"
+
+# --- Live stream (SSE) ---
+SSE_HEARTBEAT = float(os.getenv("VC_SSE_HEARTBEAT_S", 15))
+SSE_MAX_CLIENTS = int(os.getenv("VC_SSE_MAX_CLIENTS", 1000))   # per worker
+SSE_CLIENT_BACKLOG = 256   # queued batches before a slow client is dropped
+
+# --- Scripts ---
+# One atomic round trip per batch: INCRBY the counter, LPUSH + LTRIM the docs,
+# XADD them to the time-indexed stream, bump the per-day / per-hour rollup
+# counters, add the visitors to the unique-visitor HyperLogLogs and top-N
+# sketches, and PUBLISH the batch.
+# ARGV[1] = list cap, ARGV[2] = channel, ARGV[3] = stream MINID (entries
+# older than the retention window are trimmed), ARGV[4] = m, ARGV[5] = count
+# offset (the other shards' counts, 0 unsharded), ARGV[6] = marker ttl,
+# ARGV[7..m+6] = v1 record prefixes (oldest first); the script appends each
+# count_after. The batch is published as netstrings (`<len>:<record>...`).
+# KEYS[1..4] are the shard's counter, list, stream and this call's marker: if
+# the marker exists the call already ran (a retry after a timeout) and its
+# count is returned without writing. KEYS[5..] follow in four sections, each read from ARGV as a count, then:
+#   guard:           rate per s, burst, now (ms), dedupe window (s); (bucket, dedupe) keys per record
+#   rollup counters: (increment, ttl) per key
+#   HyperLogLogs:    (member count, ttl, members...) per key
+#   top-N sketches:  capacity once, then (pair count, ttl, (member, increment)...) per key
+# The guard runs first: if it turns any record away (1 = rate limited,
+# 2 = duplicate) the script returns those codes, one per record, and
+# writes nothing else; rejected hits leave no trace at all.
+# Top-N sets are Space-Saving sketches: a new member arriving at a full set
+# replaces the current minimum and inherits its count, so memory stays at
+# the capacity and every heavy hitter is kept (counts may overestimate).
+# Shared with backup.py's import script.
+SPACE_SAVING_LUA = """
+local function space_saving(key, member, inc, k)
+  if redis.call('ZSCORE', key, member) or redis.call('ZCARD', key) < k then
+    redis.call('ZINCRBY', key, inc, member)
+  else
+    local low = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+    redis.call('ZREM', key, low[1])
+    redis.call('ZADD', key, tonumber(low[2]) + inc, member)
+  end
+end
+"""
+INGEST_LUA = SPACE_SAVING_LUA + """
+local function guard(bucket, seen, rate, burst, now, window)
+  if rate > 0 then
+    local b = redis.call('HMGET', bucket, 't', 'at')
+    local tokens = math.min(burst, (tonumber(b[1]) or burst) + (now - (tonumber(b[2]) or now)) * rate / 1000)
+    if tokens < 1 then
+      return 1
+    end
+    redis.call('HSET', bucket, 't', tokens - 1, 'at', now)
+    redis.call('PEXPIRE', bucket, math.ceil(burst / rate * 1000))
+  end
+  if window > 0 and not redis.call('SET', seen, 1, 'NX', 'EX', window) then
+    return 2
+  end
+  return 0
+end
+
+local done = redis.call('GET', KEYS[4])
+if done then
+  return tonumber(done)
+end
+local m = tonumber(ARGV[4])
+local a, j = m + 6, 5
+local function arg()
+  a = a + 1
+  return ARGV[a]
+end
+if tonumber(arg()) > 0 then
+  local rate = tonumber(arg())
+  local burst = tonumber(arg())
+  local now = tonumber(arg())
+  local window = tonumber(arg())
+  local codes, rejected = {}, false
+  for i = 1, m do
+    codes[i] = guard(KEYS[j], KEYS[j + 1], rate, burst, now, window)
+    rejected = rejected or codes[i] > 0
+    j = j + 2
+  end
+  if rejected then
+    return codes
+  end
+end
+local n = redis.call('INCRBY', KEYS[1], m)
+local first = n - m + tonumber(ARGV[5])
+local docs, frames = {}, {}
+for i = 1, m do
+  docs[i] = ARGV[i + 6] .. (first + i)
+  frames[i] = #docs[i] .. ':' .. docs[i]
+  redis.call('XADD', KEYS[3], 'MINID', '~', ARGV[3], '*', 'r', docs[i])
+end
+redis.call('LPUSH', KEYS[2], unpack(docs))
+redis.call('LTRIM', KEYS[2], 0, tonumber(ARGV[1]) - 1)
+redis.call('PUBLISH', ARGV[2], table.concat(frames))
+for _ = 1, tonumber(arg()) do
+  redis.call('INCRBY', KEYS[j], arg())
+  redis.call('EXPIRE', KEYS[j], arg())
+  j = j + 1
+end
+for _ = 1, tonumber(arg()) do
+  local c = tonumber(arg())
+  local ttl = arg()
+  redis.call('PFADD', KEYS[j], unpack(ARGV, a + 1, a + c))
+  redis.call('EXPIRE', KEYS[j], ttl)
+  a, j = a + c, j + 1
+end
+local sections = tonumber(arg())
+local k = tonumber(arg())
+for _ = 1, sections do
+  local c = tonumber(arg())
+  local ttl = arg()
+  for _ = 1, c do
+    local member = arg()
+    space_saving(KEYS[j], member, tonumber(arg()), k)
+  end
+  redis.call('EXPIRE', KEYS[j], ttl)
+  j = j + 1
+end
+redis.call('SET', KEYS[4], n, 'EX', ARGV[6])
+return n
+"""
+ingest_script = r.register_script(INGEST_LUA)  # EVALSHA, falls back to SCRIPT LOAD once
+
+# Look up a user agent's id, assigning the next one on first sight; 0 once
+# ARGV[2] ids are taken (the caller stores the user agent inline).
+INTERN_UA_LUA = """
+local id = redis.call('HGET', KEYS[1], ARGV[1])
+if id then return tonumber(id) end
+if tonumber(redis.call('GET', KEYS[3]) or '0') >= tonumber(ARGV[2]) then return 0 end
+id = redis.call('INCR', KEYS[3])
+redis.call('HSET', KEYS[1], ARGV[1], id)
+redis.call('HSET', KEYS[2], id, ARGV[1])
+return id
+"""
+intern_ua_script = r.register_script(INTERN_UA_LUA)
+
+# Replay of spooled visits: INGEST_LUA behind a compare-and-set on the spool
+# file's replayed-bytes offset, so every line is ingested exactly once even
+# when several workers replay the same file. KEYS[#KEYS] = offset key; the
+# last three ARGV = expected offset, new offset, key ttl (INGEST_LUA ignores
+# the extras). Returns -1 without writing if the offset has moved. Lines whose
+# ingest call committed before timing out were dropped by replay_batch, so a
+# batch may be empty: then only the offset moves.
+SPOOL_REPLAY_LUA = """
+local ok, na = KEYS[#KEYS], #ARGV
+if (tonumber(redis.call('GET', ok) or '0') or -1) ~= tonumber(ARGV[na - 2]) then
+  return -1
+end
+redis.call('SET', ok, ARGV[na - 1], 'EX', ARGV[na])
+if tonumber(ARGV[4]) == 0 then
+  return tonumber(redis.call('GET', KEYS[1]) or '0')
+end
+""" + INGEST_LUA
+spool_script = r.register_script(SPOOL_REPLAY_LUA)
 
 # --- Helpers ---
-def now_iso():
-    return datetime.utcnow().isoformat() + "Z"
+_iso_secs = {}    # epoch second -> "YYYY-MM-DDTHH:MM:SS"; visits cluster, so this hits
+
+def iso_from_ms(ms):
+    sec, frac = divmod(ms, 1000)
+    head = _iso_secs.get(sec)
+    if head is None:
+        if len(_iso_secs) >= 4096:
+            _iso_secs.clear()
+        head = _iso_secs[sec] = datetime.utcfromtimestamp(sec).strftime("%Y-%m-%dT%H:%M:%S")
+    return f"{head}.{frac:03d}Z"
+
+def ms_from_iso(s):
+    """Epoch ms from ISO 8601; without an offset the time is taken as UTC."""
+    dt = datetime.fromisoformat(s[:-1] + "+00:00" if s.endswith("Z") else s)
+    dt = dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt.astimezone(timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+def encode_record(doc, ua_id):
+    """v1 record prefix for doc; the ingest script appends count_after. ua_id 0 stores the user agent inline."""
+    ip = doc["ip_address"]
+    for kind, family in ((4, socket.AF_INET), (6, socket.AF_INET6)):
+        try:
+            packed = socket.inet_pton(family, ip)
+            break
+        except OSError:
+            pass
+    else:
+        packed, kind = ip.encode()[:255], 0
+    head = _REC_HEAD.pack(REC_V1, ms_from_iso(doc["created_date"]), ua_id, kind, len(packed)) + packed
+    if ua_id:
+        return head
+    ua = doc["user_agent"].encode()
+    return head + _UA_LEN.pack(len(ua)) + ua
+
+def parse_record(raw):
+    """A legacy JSON doc as a dict, or a v1 record as (ts_ms, ua, ip, count_after).
+
+    ua is the user agent id, or the user agent itself (str) if it was stored inline.
+    """
+    if raw[:1] == b"{":
+        return json.loads(raw)
+    _, ts_ms, ua, kind, ip_len = _REC_HEAD.unpack_from(raw)
+    off = _REC_HEAD.size
+    ip_raw = raw[off:off + ip_len]
+    ip = socket.inet_ntop(_IP_FAMILY[kind], ip_raw) if kind else ip_raw.decode("utf-8", "replace")
+    off += ip_len
+    if not ua:
+        (ua_len,) = _UA_LEN.unpack_from(raw, off)
+        off += _UA_LEN.size
+        ua, off = raw[off:off + ua_len].decode("utf-8", "replace"), off + ua_len
+    return ts_ms, ua, ip, int(raw[off:])
+
+def ua_name(ua, ua_names):
+    return ua if isinstance(ua, str) else ua_names.get(ua, "unknown")
+
+def visit_dict(parsed, ua_names):
+    if isinstance(parsed, dict):
+        return parsed
+    ts_ms, ua, ip, count_after = parsed
+    return {"created_date": iso_from_ms(ts_ms), "ip_address": ip,
+            "user_agent": ua_name(ua, ua_names), "count_after": count_after}
+
+def parse_frames(payload):
+    """Split a published batch of netstrings back into records."""
+    out, i = [], 0
+    while i < len(payload):
+        j = payload.index(b":", i)
+        n = int(payload[i:j])
+        out.append(payload[j + 1:j + 1 + n])
+        i = j + 1 + n
+    return out
+
+_ua_ids = {}      # user agent -> id
+_ua_names = {}    # id -> user agent
+
+def remember_ua(ua, ua_id):
+    if len(_ua_ids) >= UA_CACHE_MAX:
+        _ua_ids.clear()
+        _ua_names.clear()
+    _ua_ids[ua] = ua_id   # 0: dictionary full, store inline (ids are never freed, so this stays true)
+    if ua_id:
+        _ua_names[ua_id] = ua
+
+def missing_ua_ids(parsed):
+    return sorted({p[1] for p in parsed if not isinstance(p, dict) and isinstance(p[1], int)
+                   and p[1] not in _ua_names})
+
+def intern_ua(ua):
+    ua_id = _ua_ids.get(ua)
+    if ua_id is None:
+        ua_id = int(intern_ua_script(keys=[K_UA_IDS, K_UA_NAMES, K_UA_SEQ], args=[ua, UA_DICT_MAX], client=r))
+        remember_ua(ua, ua_id)
+    return ua_id
+
+def learn_uas(docs):
+    """Intern the user agents of accepted visits that went out inline, for their next visit.
+
+    Best effort: the visits are already written, so a Redis error here must not fail them.
+    """
+    with suppress(redis.RedisError):
+        for d in docs:
+            if d["user_agent"] not in _ua_ids:
+                intern_ua(d["user_agent"])
+
+def resolve_uas(parsed):
+    """Load the names of user agent ids this worker hasn't seen yet, in one HMGET."""
+    load_ua_names(missing_ua_ids(parsed))
+
+def load_ua_names(ids):
+    missing = sorted({i for i in ids if i not in _ua_names})
+    if missing:
+        for ua_id, name in zip(missing, r.hmget(K_UA_NAMES, missing)):
+            if name is not None:
+                remember_ua(name.decode("utf-8", "replace"), ua_id)
+
+def decode_visits(raws):
+    """Decode list entries (v1 or legacy JSON) to dicts."""
+    parsed = [parse_record(x) for x in raws]
+    resolve_uas(parsed)
+    return [visit_dict(p, _ua_names) for p in parsed]
+
+def parse_for_json(raws):
+    # Legacy entries already are JSON and are passed through as-is.
+    return [x if x[:1] == b"{" else parse_record(x) for x in raws]
+
+_json_str = json.encoder.encode_basestring_ascii
+
+def visit_json(parsed):
+    """visit_dict(parsed) serialized directly, same keys and escaping as json.dumps."""
+    ts_ms, ua, ip, count_after = parsed
+    return (f'{{"created_date":"{iso_from_ms(ts_ms)}","ip_address":{_json_str(ip)},'
+            f'"user_agent":{_json_str(ua_name(ua, _ua_names))},"count_after":{count_after}}}').encode()
+
+def json_items(parsed):
+    """JSON bytes per entry of parse_for_json(); call resolve_uas() first."""
+    return [p if isinstance(p, bytes) else visit_json(p) for p in parsed]
+
+def json_head(ndjson, total):
+    return b"" if ndjson else b'{"total":%d,"items":[' % total
+
+def json_chunk(items, ndjson, first):
+    """Body bytes for one chunk of json_items(): NDJSON lines, or array elements."""
+    if ndjson:
+        return b"".join(i + b"\n" for i in items)
+    return (b"" if first else b",") + b",".join(items)
+
+def next_chunk(top, next_count, limit):
+    """LRANGE bounds for the chunk starting at count_after == next_count, given vc:count == top."""
+    start = top - next_count
+    return start, start + min(STREAM_CHUNK, limit) - 1
+
+def per_shard(queue, shards=None):
+    """Run queue(pipe, shard) for every shard, one pipeline per Redis client; results per shard."""
+    shards = shards or SHARDS
+    out = {}
+    for group in by_client(shards):
+        pipe = group[0].client.pipeline(transaction=False)
+        sizes = []
+        for s in group:
+            before = len(pipe)
+            queue(pipe, s)
+            sizes.append(len(pipe) - before)
+        results, i = pipe.execute(), 0
+        for s, size in zip(group, sizes):
+            out[s.index] = results[i:i + size]
+            i += size
+    return [out[s.index] for s in shards]
+
+def merge_records(lists, limit):
+    """Parsed v1 records of several shard lists, newest first."""
+    parsed = [parse_record(x) for raws in lists for x in raws]
+    parsed.sort(key=lambda p: (p[0], p[3]), reverse=True)
+    return parsed[:limit]
+
+def decode_merged(lists, limit):
+    if len(lists) == 1:
+        return decode_visits(lists[0][:limit])
+    parsed = merge_records(lists, limit)
+    resolve_uas(parsed)
+    return [visit_dict(p, _ua_names) for p in parsed]
+
+_last_count = 0   # last count seen by this worker, served while Redis is unavailable
+_shard_counts = [0] * len(SHARDS)   # last known counter per shard
+_total_expires = 0.0
 
 def get_total_count():
-    val = r.get(K_VISIT_COUNT)
-    return int(val) if val else 0
+    """vc:count, or the sum of the shard counters (re-read at most every TOTAL_TTL)."""
+    global _last_count, _total_expires
+    if len(SHARDS) == 1:
+        val = r.get(K_VISIT_COUNT)
+        _last_count = int(val) if val else 0
+        return _last_count
+    now = time.monotonic()
+    if now >= _total_expires:
+        counts = [int(res[0] or 0) for res in per_shard(lambda pipe, s: pipe.get(s.count))]
+        _shard_counts[:] = counts
+        _last_count, _total_expires = sum(counts), now + TOTAL_TTL
+    return _last_count
 
 def list_visits(limit=100):
-    raw = r.lrange(K_VISITS_LIST, 0, max(1, min(int(limit), 1000)) - 1)
-    return [json.loads(x) for x in raw]
+    n = max(1, min(int(limit), VISITS_CAP))
+    if len(SHARDS) == 1:
+        return decode_visits(r.lrange(K_VISITS_LIST, 0, n - 1))
+    return decode_merged([res[0] for res in per_shard(lambda pipe, s: pipe.lrange(s.visits, 0, n - 1))], n)
 
-def create_visit(ip: str, ua: str):
-    count_after = r.incr(K_VISIT_COUNT)
-    doc = {
-        "created_date": now_iso(),
+def iter_visits_json(total, limit, ndjson=False):
+    """Yield the body of the newest `limit` visits as they are read, in chunks.
+
+    Every chunk is read together with vc:count in one MULTI. The list is
+    ordered by count_after without gaps, so when visits were pushed since
+    the previous chunk the read is shifted by exactly that many entries,
+    which are skipped; no visit is sent twice or missed. Shard lists have no
+    common order to chunk by, so sharded they are read at once and merged.
+    """
+    yield json_head(ndjson, total)
+    if len(SHARDS) > 1:
+        parsed = merge_records([res[0] for res in per_shard(lambda pipe, s: pipe.lrange(s.visits, 0, limit - 1))],
+                               limit)
+        resolve_uas(parsed)
+        if parsed:
+            yield json_chunk(json_items(parsed), ndjson, True)
+        if not ndjson:
+            yield b"]}"
+        return
+    top, next_count, left, first = total, total, limit, True
+    while left > 0 and next_count > 0:
+        pipe = r.pipeline(transaction=True)
+        pipe.get(K_VISIT_COUNT)
+        pipe.lrange(K_VISITS_LIST, *next_chunk(top, next_count, left))
+        now, raw = pipe.execute()
+        shift, top = int(now or 0) - top, int(now or 0)
+        raw = raw[max(0, shift):]
+        if not raw:
+            if shift == 0:
+                break   # reached the end of the (capped) list
+            continue
+        parsed = parse_for_json(raw)
+        resolve_uas(parsed)
+        yield json_chunk(json_items(parsed), ndjson, first)
+        first = False
+        next_count -= len(raw)
+        left -= len(raw)
+    if not ndjson:
+        yield b"]}"
+
+def list_visits_since(since, total, limit=100):
+    """Visits with count_after > since, newest first.
+
+    The list is ordered by count_after with no gaps (each ingest assigns a
+    contiguous range and pushes it atomically), so the new visits are exactly
+    the first total - since entries.
+    """
+    n = min(max(0, total - since), limit)
+    if n == 0:
+        return []
+    return [v for v in list_visits(n) if v.get("count_after", 0) > since]
+
+def parse_time_ms(s, end=False):
+    """Epoch ms from "1700000000000", "2024-05-01" or "2024-05-01T12:00:00Z".
+
+    With end, a bare date is the last millisecond of that day, so an inclusive
+    upper bound covers the whole day.
+    """
+    if s.isdigit():
+        return int(s)
+    if end and len(s) == 10:
+        return ms_from_iso(s) + 86400000 - 1
+    return ms_from_iso(s)
+
+def range_bounds(args):
+    """XRANGE start ids (one per shard) and end id for ?from=&to=&cursor=.
+
+    from/to are inclusive. Unsharded, cursor is the id of the last entry of
+    the previous page and the next page starts right after it; sharded, it
+    holds the next start id of every shard, comma-separated. Raises
+    ValueError on bad input.
+    """
+    start = "-" if args.get("from") is None else str(parse_time_ms(args["from"]))
+    end = "+" if args.get("to") is None else str(parse_time_ms(args["to"], end=True))
+    cursor = args.get("cursor")
+    if not cursor:
+        return (start,) * len(SHARDS), end
+    parts = cursor.split(",")
+    if len(parts) != len(SHARDS):
+        raise ValueError("cursor does not match the shard count")
+    if len(SHARDS) == 1:
+        ms, seq = cursor.split("-")
+        return (f"{int(ms)}-{int(seq) + 1}",), end
+    return tuple(p if p == "-" else "-".join(str(int(x)) for x in p.split("-", 1)) for p in parts), end
+
+def range_page(ids, items, limit):
+    """Page body for one XRANGE read: items tagged with their stream id, plus the next cursor."""
+    for eid, v in zip(ids, items):
+        v["id"] = eid
+    return {"items": items, "cursor": ids[-1] if len(ids) == limit else None}
+
+def list_visits_range(starts, end, limit=100):
+    if len(SHARDS) == 1:
+        entries = r.xrange(K_VISITS_STREAM, starts[0], end, count=limit)
+        return range_page([eid.decode() for eid, _ in entries],
+                          decode_visits([fields[b"r"] for _, fields in entries]), limit)
+    # Read a page from every shard, merge by entry id, keep the first `limit`.
+    per = per_shard(lambda pipe, s: pipe.xrange(s.stream, starts[s.index], end, count=limit))
+    entries = sorted((tuple(map(int, eid.split(b"-"))), i, eid.decode(), fields[b"r"])
+                     for i, res in enumerate(per) for eid, fields in res[0])[:limit]
+    page = range_page([e[2] for e in entries], decode_visits([e[3] for e in entries]), limit)
+    if page["cursor"]:
+        nexts = list(starts)
+        for (ms, seq), i, _, _ in entries:
+            nexts[i] = f"{ms}-{seq + 1}"
+        page["cursor"] = ",".join(nexts)
+    return page
+
+def today_key():
+    return K_DAY + datetime.utcnow().strftime("%Y-%m-%d")
+
+def ingest_command(docs, ua_ids, shard=None, offset=0, guarded=True, token=None):
+    """KEYS and ARGV for one INGEST_LUA call writing docs (oldest first) to a shard.
+
+    token names the call's marker; pass the same one to re-send a call that may have run.
+    """
+    s = shard or SHARDS[0]
+    token = token or os.urandom(8).hex()
+    guard_keys = []
+    guard_args = [0]
+    if guarded and (GUARD_RATE > 0 or DEDUPE_WINDOW > 0):
+        guard_args = [1, GUARD_RATE, GUARD_BURST, int(time.time() * 1000), DEDUPE_WINDOW]
+        for d in docs:
+            visitor = f"{d['ip_address']}|{d['user_agent']}".encode()
+            guard_keys += [s.bucket + d["ip_address"], s.seen + hashlib.blake2b(visitor, digest_size=8).hexdigest()]
+    rollups, uniques, tops = {}, {}, {}
+    for d, ua_id in zip(docs, ua_ids):
+        ts = d["created_date"]  # ISO UTC: YYYY-MM-DDTHH:...
+        day, hour = ts[:10], ts[:13]
+        for key, ttl in ((s.day + day, DAY_TTL), (s.hour + hour, HOUR_TTL)):
+            rollups[key] = (rollups[key][0] + 1, ttl) if key in rollups else (1, ttl)
+        visitor = f"{d['ip_address']}|{d['user_agent']}"
+        for key, ttl in ((s.uniq_day + day, DAY_TTL), (s.uniq_hour + hour, HOUR_TTL)):
+            uniques.setdefault(key, (ttl, set()))[1].add(visitor)
+        # User agents stored inline are ranked as "~<user agent>".
+        for key, member in ((s.top_ip + day, d["ip_address"]), (s.top_ua + day, ua_id or "~" + d["user_agent"])):
+            counts = tops.setdefault(key, {})
+            counts[member] = counts.get(member, 0) + 1
+    args = [VISITS_CAP, CH_VISITS, int(time.time() * 1000) - RETENTION_MS, len(docs), offset, INGEST_MARK_TTL]
+    args += [encode_record(d, ua_id) for d, ua_id in zip(docs, ua_ids)]
+    args += guard_args
+    args.append(len(rollups))
+    for inc, ttl in rollups.values():
+        args += [inc, ttl]
+    args.append(len(uniques))
+    for ttl, members in uniques.values():
+        args += [len(members), ttl, *members]
+    args += [len(tops), TOP_K]
+    for counts in tops.values():
+        args += [len(counts), DAY_TTL]
+        for member, inc in counts.items():
+            args += [member, inc]
+    return [s.count, s.visits, s.stream, s.ingested + token] + guard_keys + list(rollups) + list(uniques) + list(tops), args
+
+def assign_counts(docs, n):
+    # The script returns the count after the batch; docs got the n - len + 1 .. n range.
+    first = n - len(docs)
+    for i, d in enumerate(docs, 1):
+        d["count_after"] = first + i
+
+def ingest_batch(docs):
+    """Write docs (oldest first), one round trip per shard, and fill in their count_after."""
+    global _last_count
+    groups = {}
+    for d in docs:
+        group = groups.setdefault(shard_for(d["ip_address"]).index, [])
+        group.append(d)
+    for i, group in groups.items():
+        # Sharded, count_after is the shard's count plus the others' last known counts.
+        offset = sum(_shard_counts) - _shard_counts[i]
+        # One token per call: redis-py re-sends it on a timeout, and the spool keeps it so
+        # replay skips visits whose call committed before the timeout.
+        token = os.urandom(8).hex()
+        try:
+            # Guarded, unknown user agents go out inline and are interned once the hit is
+            # accepted, so rejected floods (a bot rotating user agents) never reach the dictionary.
+            ua_ids = [intern_ua(d["user_agent"]) if guard is None else _ua_ids.get(d["user_agent"], 0)
+                      for d in group]
+            keys, args = ingest_command(group, ua_ids, SHARDS[i], offset, token=token)
+            n = ingest_script(keys=keys, args=args, client=SHARDS[i].client)
+            if isinstance(n, list):
+                # The guard turned some away and nothing was written; write the others unguarded.
+                group = [d for d, code in zip(group, n) if not guard.rejected(d, code)]
+                if not group:
+                    continue
+                ua_ids = [intern_ua(d["user_agent"]) for d in group]
+                token = os.urandom(8).hex()
+                keys, args = ingest_command(group, ua_ids, SHARDS[i], offset, guarded=False, token=token)
+                n = ingest_script(keys=keys, args=args, client=SHARDS[i].client)
+            elif guard is not None:
+                for d in group:
+                    guard.accepted(d)
+        except redis.RedisError as e:
+            if metrics is not None:
+                metrics.ingest_errors.inc()
+            spool = get_spool() if isinstance(e, (redis.ConnectionError, redis.TimeoutError)) else None
+            if spool is None:
+                raise
+            # Degraded: keep the visits on local disk; count_after is an estimate.
+            assign_counts(group, sum(_shard_counts) + spool.append(SHARDS[i], group, token))
+            if metrics is not None:
+                metrics.spooled.inc(len(group))
+            continue
+        _shard_counts[i] = max(_shard_counts[i], n)
+        assign_counts(group, n + offset)
+        if guard is not None:
+            learn_uas(group)
+    if metrics is not None:
+        metrics.ingested.inc(len(docs))
+        metrics.ingest_batch.observe(len(docs))
+    _last_count = max(_last_count, sum(_shard_counts))
+    invalidate_cache()
+    return docs[-1].get("count_after")
+
+def replay_batch(shard, docs, key, start, end):
+    """Ingest spooled docs if bytes start..end of their file are the next to replay.
+
+    Returns False (writing nothing) when another replayer got there first.
+    """
+    global _last_count
+    tokens = sorted({d["ingest"] for d in docs if d.get("ingest")})
+    committed = {t for t, done in zip(tokens, shard.client.mget([shard.ingested + t for t in tokens]) if tokens else [])
+                 if done is not None}
+    docs = [d for d in docs if d.pop("ingest", None) not in committed]
+    offset = sum(_shard_counts) - _shard_counts[shard.index]
+    keys, args = ingest_command(docs, [intern_ua(d["user_agent"]) for d in docs], shard, offset, guarded=False)
+    n = spool_script(keys=keys + [key], args=args + [start, end, SPOOL_KEY_TTL], client=shard.client)
+    if n < 0:
+        return False
+    _shard_counts[shard.index] = max(_shard_counts[shard.index], n)
+    _last_count = max(_last_count, sum(_shard_counts))
+    if metrics is not None:
+        metrics.replayed.inc(len(docs))
+    invalidate_cache()
+    return True
+
+class BufferFull(Exception):
+    pass
+
+class RateLimited(Exception):
+    pass
+
+class IngestGuard:
+    """Per-worker side of the ingest guard: a pre-filter and the counters.
+
+    A worker sees a subset of an IP's hits, so once its own bucket for an IP
+    is empty the shared one in Redis is too, and an (IP, user agent) it got
+    accepted within the window is still a duplicate there: check() turns
+    both away without a Redis call. Local buckets only spend tokens the
+    Redis guard spent, so the pre-filter never rejects what Redis would take.
+    """
+
+    def __init__(self, rate, burst, window, max_entries):
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+        self.max_entries = max_entries
+        self.buckets = {}     # ip -> (tokens, monotonic time)
+        self.seen = {}        # (ip, user agent) -> monotonic expiry
+        self.counts = {}      # (result, where) -> visits turned away
+        self.lock = threading.Lock()
+
+    def check(self, doc):
+        """"dropped", "deduped" or None (ask Redis) for a new visit."""
+        ip, now = doc["ip_address"], time.monotonic()
+        with self.lock:
+            if self.rate > 0 and self._tokens(ip, now) < 1:
+                return self._count("dropped", "local")
+            if self.seen.get((ip, doc["user_agent"]), 0) > now:
+                return self._count("deduped", "local")
+        return None
+
+    def rejected(self, doc, code):
+        """Record the Redis guard's code for doc; true if it was turned away."""
+        if code == 0:
+            self.accepted(doc)
+            return False
+        with self.lock:
+            if code == 2:
+                self._spend(doc["ip_address"], time.monotonic())
+            doc["guard"] = self._count("dropped" if code == 1 else "deduped", "redis")
+        return True
+
+    def accepted(self, doc):
+        ip, now = doc["ip_address"], time.monotonic()
+        with self.lock:
+            self._spend(ip, now)
+            if self.window > 0:
+                if len(self.seen) >= self.max_entries:
+                    self.seen.clear()
+                self.seen[(ip, doc["user_agent"])] = now + self.window
+
+    def stats(self):
+        with self.lock:
+            return {f"{result}_{where}": n for (result, where), n in sorted(self.counts.items())}
+
+    def _tokens(self, ip, now):
+        tokens, at = self.buckets.get(ip, (self.burst, now))
+        return min(self.burst, tokens + (now - at) * self.rate)
+
+    def _spend(self, ip, now):
+        if self.rate > 0:
+            if len(self.buckets) >= self.max_entries:
+                self.buckets.clear()
+            self.buckets[ip] = (self._tokens(ip, now) - 1, now)
+
+    def _count(self, result, where):
+        self.counts[result, where] = self.counts.get((result, where), 0) + 1
+        if metrics is not None:
+            metrics.guard.labels(result, where).inc()
+        return result
+
+guard = IngestGuard(GUARD_RATE, GUARD_BURST, DEDUPE_WINDOW, GUARD_LOCAL_MAX) \
+    if GUARD_RATE > 0 or DEDUPE_WINDOW > 0 else None
+
+class _Pending:
+    __slots__ = ("doc", "done", "error")
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.done = threading.Event()
+        self.error = None
+
+_STOP = object()
+
+class VisitBuffer:
+    """In-process write-behind queue drained by a single flusher thread.
+
+    A batch is flushed when it reaches max_batch docs or max_delay seconds
+    after its first doc, whichever comes first. Batches are written in queue
+    order, so count_after values stay monotonic within the worker.
+    """
+
+    def __init__(self, max_batch, max_delay, max_queue, on_full, block_timeout):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.on_full = on_full
+        self.block_timeout = block_timeout
+        self.q = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self._run, name="vc-flusher", daemon=True)
+        self.thread.start()
+
+    def submit(self, doc):
+        item = _Pending(doc)
+        try:
+            if self.on_full == "block":
+                self.q.put(item, timeout=self.block_timeout)
+            else:
+                self.q.put_nowait(item)
+        except queue.Full:
+            if self.on_full == "sync":
+                ingest_batch([doc])
+                return doc.get("count_after")
+            raise BufferFull()
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return doc.get("count_after")
+
+    def close(self, timeout=10):
+        """Flush everything queued so far and stop the flusher thread."""
+        self.q.put(_STOP)
+        self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self.q.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                left = deadline - time.monotonic()
+                try:
+                    item = self.q.get(timeout=left) if left > 0 else self.q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    self._flush(batch)
+                    return
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch):
+        try:
+            ingest_batch([p.doc for p in batch])
+        except Exception as e:
+            for p in batch:
+                p.error = e
+        for p in batch:
+            p.done.set()
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+def get_buffer():
+    # Created lazily so the flusher thread starts in the serving process, not before a fork.
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = VisitBuffer(BUFFER_MAX_BATCH, BUFFER_MAX_DELAY, BUFFER_MAX_QUEUE,
+                                  BUFFER_FULL, BUFFER_BLOCK_TIMEOUT)
+        return _buffer
+
+class Spool:
+    """Append-only files of visits that could not be written to Redis.
+
+    append() writes one JSON line per visit to this worker's file for the
+    shard (<shard>-<pid>-<ms>.spool, opened O_APPEND) and returns at once; a
+    sync thread fsyncs written files every `fsync_interval` seconds. A replay
+    thread drains every spool file in the directory, including those of other
+    and earlier workers, `batch` lines per script call. The file's replayed
+    offset is checked and advanced in the same script as the ingest, so each
+    line is replayed exactly once and in file order (count_after order).
+    Drained files are removed: this worker's at once, others' when idle.
+    """
+
+    def __init__(self, directory, fsync_interval, batch, replay_interval, idle):
+        os.makedirs(directory, exist_ok=True)
+        self.dir = directory
+        self.fsync_interval = fsync_interval
+        self.batch = batch
+        self.replay_interval = replay_interval
+        self.idle = idle
+        self.files = {}           # shard index -> [name, fd, visits] of this worker's open file
+        self.dirty = set()        # fds written since the last fsync
+        self.pending = 0          # visits in this worker's files not yet replayed
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.threads = [threading.Thread(target=self._sync_loop, name="vc-spool-sync", daemon=True),
+                        threading.Thread(target=self._replay_loop, name="vc-spool-replay", daemon=True)]
+        for t in self.threads:
+            t.start()
+
+    def append(self, shard, docs, token=None):
+        """Spool docs for shard; returns the visits this worker now has spooled.
+
+        token is the failed ingest call's; replay skips the docs if that call committed.
+        """
+        data = "".join(json.dumps(dict(d, ingest=token), separators=(",", ":")) + "\n" for d in docs).encode()
+        with self.lock:
+            f = self.files.get(shard.index)
+            if f is None or os.fstat(f[1]).st_nlink == 0:   # none yet, or removed by another replayer
+                if f is not None:
+                    os.close(f[1])
+                    self.pending -= f[2]
+                name = f"{shard.index}-{os.getpid()}-{int(time.time() * 1000)}.spool"
+                f = self.files[shard.index] = [name, os.open(os.path.join(self.dir, name),
+                                                             os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644), 0]
+            os.write(f[1], data)
+            f[2] += len(docs)
+            self.dirty.add(f[1])
+            self.pending += len(docs)
+            return self.pending
+
+    def sync(self):
+        with self.lock:
+            fds, self.dirty = self.dirty, set()
+        for fd in fds:   # outside the lock: appends never wait for the disk
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass     # closed after its file was drained
+
+    def replay(self):
+        """Drain every spool file into Redis; returns the number of visits replayed."""
+        replayed = 0
+        for name in sorted(os.listdir(self.dir)):
+            if name.endswith(".spool"):
+                with suppress(FileNotFoundError):   # removed by another replayer meanwhile
+                    replayed += self._replay_file(name)
+        return replayed
+
+    def close(self):
+        self.stopped.set()
+        for t in self.threads:
+            t.join(5)
+        self.sync()
+        with self.lock:
+            for _, fd, _ in self.files.values():
+                os.close(fd)
+            self.files.clear()
+
+    def _sync_loop(self):
+        while not self.stopped.wait(self.fsync_interval):
+            self.sync()
+
+    def _replay_loop(self):
+        while not self.stopped.wait(self.replay_interval):
+            try:
+                self.replay()
+            except Exception:
+                pass   # Redis still down (or the file went away); retry next interval
+
+    def _replay_file(self, name):
+        shard = SHARDS[int(name.split("-", 1)[0]) % len(SHARDS)]
+        key = shard.spool + name
+        path = os.path.join(self.dir, name)
+        replayed = 0
+        with open(path, "rb") as f:
+            while True:
+                val = shard.client.get(key)
+                if val == b"done":   # drained by a worker that did not get to remove it
+                    with suppress(FileNotFoundError):
+                        os.unlink(path)
+                    return replayed
+                start = end = int(val or 0)
+                f.seek(start)
+                lines = []
+                while len(lines) < self.batch:
+                    line = f.readline()
+                    if not line.endswith(b"\n"):   # end of file, or a line cut short by a crash
+                        break
+                    lines.append(line)
+                    end += len(line)
+                if not lines:
+                    break
+                if replay_batch(shard, [json.loads(x) for x in lines], key, start, end):
+                    replayed += len(lines)
+        with suppress(FileNotFoundError):
+            self._remove(name, path, key, shard, end)
+        return replayed
+
+    def _remove(self, name, path, key, shard, end):
+        with self.lock:
+            own = next((i for i, f in self.files.items() if f[0] == name), None)
+            if own is not None:
+                if os.path.getsize(path) != end:
+                    return   # appended to since it was read
+            elif time.time() - os.path.getmtime(path) < self.idle:
+                return
+            shard.client.set(key, "done", ex=SPOOL_KEY_TTL)   # fails any replayer still on it
+            if own is not None:
+                _, fd, n = self.files.pop(own)
+                os.close(fd)
+                self.dirty.discard(fd)
+                self.pending -= n
+            os.unlink(path)
+
+_spool = None
+_spool_lock = threading.Lock()
+
+def get_spool():
+    """The worker's Spool, or None without VC_SPOOL_DIR."""
+    global _spool
+    if not SPOOL_DIR:
+        return None
+    with _spool_lock:
+        if _spool is None:
+            _spool = Spool(SPOOL_DIR, SPOOL_FSYNC, SPOOL_BATCH, SPOOL_REPLAY_INTERVAL, SPOOL_IDLE)
+        return _spool
+
+class Broadcaster:
+    """One Redis subscription per worker, fanned out to every SSE client.
+
+    Each published batch is rendered to SSE frames once and handed to all
+    client queues as (count_after, frame) pairs.
+    """
+
+    def __init__(self):
+        self.clients = set()
+        self.lock = threading.Lock()
+        # One subscriber thread per Redis server the shards publish on.
+        self.threads = [threading.Thread(target=self._run, args=(group[0].client,), name="vc-broadcaster",
+                                         daemon=True) for group in by_client()]
+        for t in self.threads:
+            t.start()
+
+    def full(self):
+        return len(self.clients) >= SSE_MAX_CLIENTS
+
+    def add(self):
+        q = queue.Queue(maxsize=SSE_CLIENT_BACKLOG)
+        with self.lock:
+            if len(self.clients) >= SSE_MAX_CLIENTS:
+                return None
+            self.clients.add(q)
+        return q
+
+    def remove(self, q):
+        with self.lock:
+            self.clients.discard(q)
+
+    def _run(self, client):
+        backoff = 0.5
+        while True:
+            try:
+                ps = client.pubsub(ignore_subscribe_messages=True)
+                ps.subscribe(CH_VISITS)
+                backoff = 0.5
+                while True:
+                    # Short polls instead of listen(): an idle channel must not trip socket_timeout.
+                    msg = ps.get_message(timeout=1.0)
+                    if msg is not None:
+                        docs = decode_visits(parse_frames(msg["data"]))
+                        self._publish([(d["count_after"], sse_frame(d)) for d in docs])
+            except Exception:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 10)
+
+    def _publish(self, events):
+        with self.lock:
+            clients = list(self.clients)
+        for q in clients:
+            try:
+                q.put_nowait(events)
+            except queue.Full:
+                # Too slow: end its stream; the browser reconnects with Last-Event-ID and catches up.
+                self.remove(q)
+                q.dropped = True
+
+def sse_frame(doc):
+    if len(SHARDS) > 1:   # count_after is no cursor across shards: no id, no Last-Event-ID
+        return f"event: visit\ndata: {json.dumps(doc)}\n\n"
+    return f"id: {doc['count_after']}\nevent: visit\ndata: {json.dumps(doc)}\n\n"
+
+_broadcaster = None
+_broadcaster_lock = threading.Lock()
+
+def get_broadcaster():
+    global _broadcaster
+    with _broadcaster_lock:
+        if _broadcaster is None:
+            _broadcaster = Broadcaster()
+        return _broadcaster
+
+def new_doc(ip, ua):
+    return {
+        "created_date": iso_from_ms(int(time.time() * 1000)),  # ms precision, as stored
         "ip_address": ip or "unknown",
-        "user_agent": ua or "unknown",
-        "count_after": count_after,
+        "user_agent": (ua or "unknown")[:UA_MAX_LEN],
     }
-    r.lpush(K_VISITS_LIST, json.dumps(doc))
-    r.ltrim(K_VISITS_LIST, 0, 999)  # cap size
-    return count_after, doc
+
+def create_visit(ip: str, ua: str):
+    doc = new_doc(ip, ua)
+    verdict = guard.check(doc) if guard is not None else None
+    if verdict is None:
+        if INGEST_MODE == "buffered":
+            get_buffer().submit(doc)
+        else:
+            ingest_batch([doc])
+        verdict = doc.pop("guard", None)
+    if verdict == "dropped":
+        raise RateLimited()
+    if verdict == "deduped":
+        doc["deduped"] = True
+        try:
+            return get_total_count(), doc
+        except redis.RedisError:
+            return _last_count, doc
+    return doc["count_after"], doc
+
+_cache = {}                 # key -> (expires_at, body bytes)
+_cache_gen = 0
+_cache_lock = threading.Lock()
+
+def invalidate_cache():
+    global _cache_gen
+    with _cache_lock:
+        _cache_gen += 1
+        _cache.clear()
+
+def cached_json(key, build):
+    """Response with the JSON bytes for key, rebuilt by build() when stale."""
+    now = time.monotonic()
+    hit = _cache.get(key)
+    if metrics is not None:
+        metrics.cache.labels("miss" if hit is None or hit[0] <= now else "hit").inc()
+    if hit is None or hit[0] <= now:
+        gen = _cache_gen
+        hit = (now + CACHE_TTL, json.dumps(build(), separators=(",", ":")).encode())
+        with _cache_lock:
+            if gen == _cache_gen and CACHE_TTL > 0:  # don't store a body built before an ingest
+                if len(_cache) >= CACHE_MAX_ENTRIES:
+                    _cache.clear()
+                _cache[key] = hit
+    return Response(hit[1], mimetype="application/json")
+
+def not_modified(tag):
+    """304 response if the client already holds the representation tagged tag."""
+    if tag in request.if_none_match:
+        resp = Response(status=304)
+        resp.set_etag(tag)
+        resp.headers["Cache-Control"] = "no-cache"
+        return resp
+    return None
+
+def tagged(resp, tag):
+    # no-cache: browsers keep the body but revalidate it with If-None-Match on every poll
+    resp.set_etag(tag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
 
 # --- API ---
-@app.route("/api/state")
+@bp.app_errorhandler(BufferFull)
+def buffer_full(_e):
+    resp = jsonify({"ok": False, "error": "ingest queue full"})
+    resp.status_code = 503
+    resp.headers["Retry-After"] = "1"
+    return resp
+
+@bp.app_errorhandler(RateLimited)
+def rate_limited(_e):
+    resp = jsonify({"ok": False, "error": "rate limited"})
+    resp.status_code = 429
+    resp.headers["Retry-After"] = str(max(1, int(1 / GUARD_RATE))) if GUARD_RATE > 0 else "1"
+    return resp
+
+@bp.app_errorhandler(redis.RedisError)
+def redis_unavailable(e):
+    resp = jsonify({"ok": False, "error": "redis unavailable"})
+    resp.status_code = 503
+    resp.headers["Retry-After"] = str(int(BREAKER_COOLDOWN))
+    return resp
+
+@bp.route("/api/state")
 def api_state():
-    return jsonify({"name": APP_NAME, "count": get_total_count()})
+    def build():
+        try:
+            return {"name": APP_NAME, "count": get_total_count()}
+        except redis.RedisError:
+            return {"name": APP_NAME, "count": _last_count, "stale": True}
+    return cached_json("state", build)
 
-@app.route("/api/visits")
-def api_visits():
-    limit = request.args.get("limit", "100")
+@bp.route("/api/health")
+def api_health():
+    return jsonify({"redis": breaker.state, "pool": pool_stats(),
+                    "guard": guard.stats() if guard is not None else None})
+
+def parse_limit(default=100):
+    limit = request.args.get("limit", str(default))
     try:
-        n = max(1, min(int(limit), 1000))
+        return max(1, min(int(limit), VISITS_CAP))
     except Exception:
-        n = 100
-    return jsonify({"items": list_visits(n), "total": get_total_count()})
+        return default
+
+def bad_request(msg):
+    resp = jsonify({"ok": False, "error": msg})
+    resp.status_code = 400
+    return resp
+
+def wants_ndjson():
+    best = request.accept_mimetypes.best_match(["application/json", NDJSON])
+    return best == NDJSON or request.args.get("format") == "ndjson"
+
+def range_requested():
+    return any(request.args.get(k) for k in ("from", "to", "cursor"))
+
+@bp.route("/api/visits")
+def api_visits():
+    # ?since=<count_after> returns only newer visits; the ETag is the current vc:count.
+    # ?from=&to=&cursor= pages through vc:stream by time instead, oldest first.
+    if range_requested():
+        return api_visits_range()
+    n = parse_limit()
+    since = request.args.get("since", type=int)
+    if since is not None and len(SHARDS) > 1:
+        return bad_request("since needs VC_SHARDS=1; page with from/to/cursor instead")
+    total = get_total_count()
+    # JSON and NDJSON are negotiated on Accept: tag them apart and say so in Vary.
+    ndjson = wants_ndjson()
+    tag = f"{total}-ndjson" if ndjson else str(total)
+    resp = not_modified(tag)
+    if resp is None:
+        if since is None and (ndjson or n > STREAM_THRESHOLD):
+            resp = tagged(Response(iter_visits_json(total, n, ndjson),
+                                   mimetype=NDJSON if ndjson else "application/json"), tag)
+        else:
+            if since is None:
+                build = lambda: {"items": list_visits(n), "total": total}
+            else:
+                build = lambda: {"items": list_visits_since(since, total, n), "total": total}
+            resp = tagged(cached_json(("visits", n, since, total), build), tag)
+    resp.vary.add("Accept")
+    return resp
+
+def api_visits_range():
+    try:
+        starts, end = range_bounds(request.args)
+    except ValueError:
+        return bad_request("from/to must be epoch ms or ISO 8601, cursor a stream id")
+    n = parse_limit(default=RANGE_MAX)
+    total = get_total_count()
+    return cached_json(("range", starts, end, n, total), lambda: list_visits_range(starts, end, n))
+
+@bp.route("/api/summary")
+def api_summary():
+    """Total, today's count and the last N visits: everything the dashboard polls for."""
+    n = parse_limit(default=14)
+    total = get_total_count()
+    day = today_key()
+    tag = f"{total}-{day[len(K_DAY):]}"
+    resp = not_modified(tag)
+    if resp is not None:
+        return resp
 
-@app.route("/api/analytics")
+    def build():
+        date = day[len(K_DAY):]
+        per = per_shard(lambda pipe, s: (pipe.get(s.day + date), pipe.lrange(s.visits, 0, n - 1)))
+        return {"total": total, "day": date, "today": sum(int(res[0] or 0) for res in per),
+                "items": decode_merged([res[1] for res in per], n), "sharded": len(SHARDS) > 1}
+
+    return tagged(cached_json(("summary", n, tag), build), tag)
+
+@bp.route("/api/analytics")
 def api_analytics():
-    items = list_visits(2000)
+    # ?from=YYYY-MM-DD&to=YYYY-MM-DD picks the daily window (default: the last 7 days);
+    # hourly counts are for the `to` day.
+    try:
+        with timed("analytics_seconds", "parse"):
+            first, last = analytics_window(request.args)
+    except ValueError:
+        return bad_request(f"from/to must be YYYY-MM-DD, at most {ANALYTICS_MAX_DAYS} days apart")
+    return cached_json(("analytics", first, last), lambda: build_analytics(first, last))
 
-    def parse_dt(s):
-        try:
-            if s.endswith("Z"):
-                s = s[:-1]
-            return datetime.fromisoformat(s)
-        except Exception:
-            return None
-
-    now = datetime.utcnow()
-    today_key = now.strftime("%Y-%m-%d")
-    last7_dt = [now - timedelta(days=i) for i in range(6, -1, -1)]
-    last7_keys = [d.strftime("%Y-%m-%d") for d in last7_dt]
-    last7_labels = [d.strftime("%b %d") for d in last7_dt]
-
-    daily_counts = {k: 0 for k in last7_keys}
-    hourly_counts = {f"{h:02d}:00": 0 for h in range(24)}
-
-    for v in items:
-        dt = parse_dt(v.get("created_date", ""))
-        if not dt:
-            continue
-        dkey = dt.strftime("%Y-%m-%d")
-        if dkey in daily_counts:
-            daily_counts[dkey] += 1
-        if dkey == today_key:
-            hourly_counts[f"{dt.hour:02d}:00"] += 1
-
-    daily = [{"date": lbl, "visits": daily_counts[k]} for k, lbl in zip(last7_keys, last7_labels)]
-    hourly = [{"hour": h, "visits": hourly_counts[h]} for h in hourly_counts]
+def build_analytics(first=None, last=None):
+    # Exact counts from the rollup keys plus the HyperLogLogs and top-N sketches, in one round trip.
+    with timed("analytics_seconds", "fetch"):
+        labels = analytics_keys(first, last)[0]
+        per = per_shard(lambda pipe, s: analytics_commands(pipe, first, last, s))
+        results = per[0] if len(per) == 1 else merge_analytics(per)
+        load_ua_names(top_ua_ids(results))
+    with timed("analytics_seconds", "build"):
+        return analytics_result(labels, results)
+
+def analytics_window(args):
+    """First and last UTC day (dates) for /api/analytics; raises ValueError on bad input."""
+    last = (datetime.strptime(args["to"], "%Y-%m-%d") if args.get("to") else datetime.utcnow()).date()
+    first = datetime.strptime(args["from"], "%Y-%m-%d").date() if args.get("from") else last - timedelta(days=6)
+    if not 0 <= (last - first).days < ANALYTICS_MAX_DAYS:
+        raise ValueError("bad window")
+    return first, last
+
+def analytics_keys(first=None, last=None, shard=None):
+    s = shard or SHARDS[0]
+    last = last or datetime.utcnow().date()
+    first = first or last - timedelta(days=6)
+    days = [first + timedelta(days=i) for i in range((last - first).days + 1)]
+    day_keys = [s.day + d.isoformat() for d in days]
+    hour_keys = [f"{s.hour}{last.isoformat()}T{h:02d}" for h in range(24)]
+    return [d.strftime("%b %d") for d in days], day_keys + hour_keys
+
+def analytics_commands(pipe, first=None, last=None, shard=None):
+    """Queue the reads for /api/analytics on pipe (sync or asyncio); returns the day labels."""
+    s = shard or SHARDS[0]
+    labels, keys = analytics_keys(first, last, s)
+    days = [k[len(s.day):] for k in keys[:len(labels)]]
+    hours = [k[len(s.hour):] for k in keys[len(labels):]]
+    pipe.mget(keys)
+    for d in days:
+        pipe.pfcount(s.uniq_day + d)
+    for h in hours:
+        pipe.pfcount(s.uniq_hour + h)
+    pipe.pfcount(*[s.uniq_day + d for d in days])   # merged: unique over the whole window
+    pipe.zunion([s.top_ip + d for d in days], withscores=True)
+    pipe.zunion([s.top_ua + d for d in days], withscores=True)
+    return labels
+
+def merge_analytics(per):
+    """Add up the analytics_commands() results of several shards.
+
+    Visit counts add up exactly. Unique counts add up exactly only when a
+    visitor always lands on the same shard (VC_SHARD_BY=ip). Top-N scores are
+    summed per member.
+    """
+    counts = [sum(int(v or 0) for v in col) for col in zip(*(res[0] for res in per))]
+    merged = [counts] + [sum(col) for col in zip(*(res[1:-2] for res in per))]
+    for i in (-2, -1):
+        scores = {}
+        for res in per:
+            for m, score in res[i]:
+                scores[m] = scores.get(m, 0) + score
+        merged.append(list(scores.items()))
+    return merged
+
+def top_ua_ids(results):
+    return [int(m) for m, _ in results[-1] if m[:1] != b"~"]
+
+def top_ua_names(scored):
+    """Top user agents by name: inline "~<user agent>" members are merged with the interned one."""
+    visits = {}
+    for m, score in scored:
+        name = m[1:].decode("utf-8", "replace") if m[:1] == b"~" else _ua_names.get(int(m), "unknown")
+        visits[name] = visits.get(name, 0) + int(score)
+    return [{"user_agent": name, "visits": c} for name, c in top_n(visits.items())]
+
+def top_n(scored):
+    return sorted(((m, int(s)) for m, s in scored), key=lambda x: -x[1])[:TOP_N]
+
+def analytics_result(day_labels, results):
+    vals = [int(v) if v else 0 for v in results[0]]
+    nd = len(day_labels)
+    uniq_days, uniq_hours = results[1:1 + nd], results[1 + nd:25 + nd]
+    window_uniques, top_ips, top_uas = results[25 + nd:]
+    daily = [{"date": lbl, "visits": v, "uniques": u} for lbl, v, u in zip(day_labels, vals[:nd], uniq_days)]
+    hourly = [{"hour": f"{h:02d}:00", "visits": v, "uniques": u}
+              for h, (v, u) in enumerate(zip(vals[nd:], uniq_hours))]
     hourly = [h for h in hourly if h["visits"] > 0]
 
-    return jsonify({"daily": daily, "hourly": hourly})
+    return {"daily": daily, "hourly": hourly, "uniques": window_uniques,
+            "top_ips": [{"ip": m.decode(), "visits": c} for m, c in top_n(top_ips)],
+            "top_user_agents": top_ua_names(top_uas)}
+
+@bp.route("/api/stream")
+def api_stream():
+    """Server-Sent Events: one `visit` event per new visit, id = count_after.
 
-@app.route("/api/incr", methods=["POST", "GET"])
+    Reconnecting clients send Last-Event-ID (or ?last_id= on first connect)
+    and get the visits they missed replayed from vc:visits first. Sharded
+    there is no such cursor: events carry no id and nothing is replayed.
+
+    The client is registered when the body is first read, not here: a
+    response that is never iterated (HEAD, a client gone before the first
+    byte) never runs the generator's cleanup and would hold its slot forever.
+    """
+    if get_broadcaster().full():
+        return jsonify({"ok": False, "error": "too many stream clients"}), 503
+    if request.method == "HEAD":
+        return Response(mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+    last = request.headers.get("Last-Event-ID", request.args.get("last_id", ""))
+    last = int(last) if last.isdigit() and len(SHARDS) == 1 else None
+
+    def gen():
+        q = get_broadcaster().add()
+        if q is None:   # filled up since the check above; the browser retries
+            return
+        try:
+            seen = last
+            yield "retry: 3000\n\n"
+            if last is not None:
+                # Subscribed before reading, so nothing falls between replay and live events.
+                missed = list_visits_since(last, get_total_count(), VISITS_CAP)
+                for doc in reversed(missed):
+                    seen = doc["count_after"]
+                    yield sse_frame(doc)
+            while True:
+                try:
+                    events = q.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if getattr(q, "dropped", False):
+                    return
+                for count_after, frame in events:
+                    if seen is None or count_after > seen:
+                        seen = count_after
+                        yield frame
+        finally:
+            get_broadcaster().remove(q)
+
+    resp = Response(gen(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"   # tell nginx not to buffer the stream
+    return resp
+
+@bp.route("/api/incr", methods=["POST", "GET"])
 def api_incr():
-    ip = request.headers.get("X-Forwarded-For", request.remote_addr or "unknown")
+    ip = request.remote_addr or "unknown"
     ua = request.headers.get("User-Agent", "unknown")
     count_after, doc = create_visit(ip, ua)
     return jsonify({"ok": True, "count": count_after, "visit": doc})
 
 # --- THEME + UI (Dark/Light toggle, “Vue-like” cards & CTA) ---
 BASE_CSS = """
-<style>
   :root {
     /* shared */
     --radius: 14px;
@@ -206,7 +1792,144 @@ BASE_CSS = """
   .title{ text-align:center; font-weight:800; letter-spacing:.2px; margin: 6px 0 8px 0; }
   .subtitle{ text-align:center; color:var(--muted); }
   .cta-row{ display:flex; gap:12px; justify-content:center; margin-top:20px; flex-wrap:wrap; }
-</style>
+"""
+
+THEME_JS = """
+function setTheme(mode){
+  document.documentElement.setAttribute('data-theme', mode);
+  localStorage.setItem('sitescope_theme', mode);
+}
+(function(){ setTheme(localStorage.getItem('sitescope_theme') || 'dark'); })();
+document.getElementById('theme-dark').addEventListener('click', ()=>setTheme('dark'));
+document.getElementById('theme-light').addEventListener('click', ()=>setTheme('light'));
+"""
+
+DASHBOARD_JS = """
+async function j(u, o){ const r = await fetch(u, o); return r.json(); }
+function fmtDate(s){
+  try{ const d = new Date(s);
+    return [d.toLocaleTimeString([], {hour:'2-digit', minute:'2-digit', second:'2-digit'}),
+            d.toLocaleDateString([], {month:'short', day:'numeric'})];
+  }catch{ return ['--:--','—']; }
+}
+
+let list = { total: 0, today: 0, day: '', items: [] };
+
+async function loadState(){
+  // /api/summary answers 304 (served from the browser cache) until a new visit arrives
+  list = await j('/api/summary?limit=14');
+  render();
+}
+
+let reload = null;
+function onVisit(v){
+  // Sharded, count_after is per-shard and can repeat: re-read the summary (at most once a second) instead.
+  if(list.sharded){ reload = reload || setTimeout(()=>{ reload = null; loadState(); }, 1000); return; }
+  if((v.count_after || 0) <= (list.total || 0)) return;
+  list.total = v.count_after;
+  if((v.created_date || '').slice(0, 10) === list.day) list.today = (list.today || 0) + 1;
+  list.items = [v].concat(list.items || []).slice(0, 14);
+  render();
+}
+
+function render(){
+  const total = list.total || 0;
+  document.getElementById('kpi-total').textContent = Intl.NumberFormat().format(total);
+
+  const items = (list.items || []);
+  const todayCount = list.today || 0;
+  document.getElementById('kpi-today').textContent = todayCount.toString();
+  document.getElementById('kpi-today-label').textContent = todayCount === 1 ? 'visit today' : 'visits today';
+  const growth = total > 0 ? ((todayCount/total)*100).toFixed(1)+'% of total' : '0% of total';
+  document.getElementById('kpi-growth').textContent = growth;
+
+  const container = document.getElementById('recent-list');
+  container.innerHTML = '';
+  if(items.length === 0){
+    container.innerHTML = '<div class="row" style="justify-content:center;color:var(--muted)">No visits yet — refresh the page.</div>';
+  }else{
+    items.forEach(v=>{
+      const [t, d] = fmtDate(v.created_date);
+      const ip = v.ip_address ? v.ip_address : 'Unknown IP';
+      const idx = (list.total || 0) - (v.count_after || 0) + 1;
+      container.insertAdjacentHTML('beforeend', `
+        <div class="row">
+          <div style="display:flex;align-items:center;gap:12px">
+            <div style="width:36px;height:36px;border-radius:999px;background:var(--chip-blue-bg);color:var(--chip-blue);display:flex;align-items:center;justify-content:center">
+              <svg width="18" height="18" viewBox="0 0 24 24" fill="none"><path d="M12 12a5 5 0 1 0 0-10 5 5 0 0 0 0 10Z" stroke="currentColor" stroke-width="2"/><path d="M2 22a10 10 0 0 1 20 0" stroke="currentColor" stroke-width="2"/></svg>
+            </div>
+            <div>
+              <div style="font-weight:600">Page Visit #${idx}</div>
+              <div class="ip"><svg width="12" height="12" viewBox="0 0 24 24" fill="currentColor"><path d="M12 2a10 10 0 1 0 0 20 10 10 0 0 0 0-20Zm0 4a6 6 0 1 1 0 12A6 6 0 0 1 12 6Z"/></svg>${ip}</div>
+            </div>
+          </div>
+          <div style="text-align:right">
+            <div style="font-weight:600">${t}</div>
+            <div class="muted" style="font-size:12px">${d}</div>
+          </div>
+        </div>
+      `);
+    });
+  }
+}
+
+// Increment button (AJAX)
+const btn = document.getElementById('btn-visit');
+btn.addEventListener('click', async ()=>{
+  btn.disabled = true;
+  try{
+    const res = await j('/api/incr', { method:'POST' });
+    if(res.visit) onVisit(res.visit);   // absent when rate limited
+  } finally { btn.disabled = false; }
+});
+
+// Initial load (server already incremented on render), then live updates over SSE.
+// EventSource reconnects by itself and resends Last-Event-ID, so missed visits are replayed.
+loadState().then(()=>{
+  if(!window.EventSource){ setInterval(loadState, 30000); return; }
+  const es = new EventSource('/api/stream?last_id=' + (list.total || 0));
+  es.addEventListener('visit', e => onVisit(JSON.parse(e.data)));
+  // A refused stream (503: worker at VC_SSE_MAX_CLIENTS) is not retried; poll instead.
+  es.onerror = ()=>{ if(es.readyState === EventSource.CLOSED) setInterval(loadState, 10000); };
+  setInterval(loadState, 300000);  // slow resync for the "today" rollover
+});
+"""
+
+ANALYTICS_JS = """
+let dailyChart, hourlyChart;
+async function j(u){ const r = await fetch(u); return r.json(); }
+
+async function load(){
+  const [sum, an] = await Promise.all([j('/api/summary?limit=1'), j('/api/analytics')]);
+
+  document.getElementById('stat-total').textContent = sum.total || 0;
+  document.getElementById('stat-today').textContent = sum.today || 0;
+
+  const dCtx = document.getElementById('dailyChart').getContext('2d');
+  if(dailyChart) dailyChart.destroy();
+  dailyChart = new Chart(dCtx, {
+    type: 'bar',
+    data: { labels: (an.daily||[]).map(x=>x.date), datasets: [{ label: 'Visits', data: (an.daily||[]).map(x=>x.visits) }] },
+    options: {
+      responsive:true,
+      scales:{ x:{ ticks:{color:getComputedStyle(document.documentElement).getPropertyValue('--muted')}, grid:{color:'rgba(148,163,184,.25)'} }, y:{ beginAtZero:true, ticks:{color:getComputedStyle(document.documentElement).getPropertyValue('--muted')}, grid:{color:'rgba(148,163,184,.25)'} } },
+      plugins:{ legend:{ labels:{ color:getComputedStyle(document.documentElement).getPropertyValue('--muted') } } }
+    }
+  });
+
+  const hCtx = document.getElementById('hourlyChart').getContext('2d');
+  if(hourlyChart) hourlyChart.destroy();
+  hourlyChart = new Chart(hCtx, {
+    type: 'line',
+    data: { labels: (an.hourly||[]).map(x=>x.hour), datasets: [{ label:'Visits', data:(an.hourly||[]).map(x=>x.visits) }] },
+    options: {
+      responsive:true,
+      scales:{ x:{ ticks:{color:getComputedStyle(document.documentElement).getPropertyValue('--muted')}, grid:{color:'rgba(148,163,184,.25)'} }, y:{ beginAtZero:true, ticks:{color:getComputedStyle(document.documentElement).getPropertyValue('--muted')}, grid:{color:'rgba(148,163,184,.25)'} } },
+      plugins:{ legend:{ labels:{ color:getComputedStyle(document.documentElement).getPropertyValue('--muted') } } }
+    }
+  });
+}
+load();
 """
 
 # ---------- LANDING (Home "/") ----------
@@ -219,7 +1942,7 @@ LANDING_HTML = """
   <title>{{ name }} | Home</title>
   <script src="https://cdn.tailwindcss.com"></script>
   <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;600;800&display=swap" rel="stylesheet">
-  {{ base_css|safe }}
+  <link href="{{ assets.base_css }}" rel="stylesheet">
 </head>
 <body>
   <div class="container" style="max-width:1100px;">
@@ -259,15 +1982,7 @@ LANDING_HTML = """
     </div>
   </div>
 
-  <script>
-    function setTheme(mode){
-      document.documentElement.setAttribute('data-theme', mode);
-      localStorage.setItem('sitescope_theme', mode);
-    }
-    (function(){ setTheme(localStorage.getItem('sitescope_theme') || 'dark'); })();
-    document.getElementById('theme-dark').addEventListener('click', ()=>setTheme('dark'));
-    document.getElementById('theme-light').addEventListener('click', ()=>setTheme('light'));
-  </script>
+  <script src="{{ assets.theme_js }}"></script>
 </body>
 </html>
 """
@@ -282,7 +1997,7 @@ DASHBOARD_HTML = """
   <title>{{ name }} | Count</title>
   <script src="https://cdn.tailwindcss.com"></script>
   <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;600;800&display=swap" rel="stylesheet">
-  {{ base_css|safe }}
+  <link href="{{ assets.base_css }}" rel="stylesheet">
 </head>
 <body>
   <div class="container">
@@ -351,89 +2066,14 @@ DASHBOARD_HTML = """
           <svg width="16" height="16" viewBox="0 0 24 24" fill="none"><path d="M12 8v4l3 3" stroke="currentColor" stroke-width="2" stroke-linecap="round"/></svg>
         </span>
         <strong>Recent Activity</strong>
-        <span class="muted" style="margin-left:auto;font-size:12px;">Auto-refreshes</span>
+        <span class="muted" style="margin-left:auto;font-size:12px;">Live</span>
       </div>
       <div id="recent-list"></div>
     </div>
   </div>
 
-  <script>
-    // Theme toggle
-    function setTheme(mode){
-      document.documentElement.setAttribute('data-theme', mode);
-      localStorage.setItem('sitescope_theme', mode);
-    }
-    (function(){ setTheme(localStorage.getItem('sitescope_theme') || 'dark'); })();
-    document.getElementById('theme-dark').addEventListener('click', ()=>setTheme('dark'));
-    document.getElementById('theme-light').addEventListener('click', ()=>setTheme('light'));
-
-    async function j(u, o){ const r = await fetch(u, o); return r.json(); }
-    function fmtDate(s){
-      try{ const d = new Date(s);
-        return [d.toLocaleTimeString([], {hour:'2-digit', minute:'2-digit', second:'2-digit'}),
-                d.toLocaleDateString([], {month:'short', day:'numeric'})];
-      }catch{ return ['--:--','—']; }
-    }
-
-    async function loadState(){
-      const st = await j('/api/state');
-      const list = await j('/api/visits?limit=999');
-
-      const total = st.count || 0;
-      document.getElementById('kpi-total').textContent = Intl.NumberFormat().format(total);
-
-      const todayStr = new Date().toDateString();
-      const items = (list.items || []);
-      const todayCount = items.filter(v => new Date(v.created_date).toDateString() === todayStr).length;
-      document.getElementById('kpi-today').textContent = todayCount.toString();
-      document.getElementById('kpi-today-label').textContent = todayCount === 1 ? 'visit today' : 'visits today';
-      const growth = total > 0 ? ((todayCount/total)*100).toFixed(1)+'% of total' : '0% of total';
-      document.getElementById('kpi-growth').textContent = growth;
-
-      const container = document.getElementById('recent-list');
-      container.innerHTML = '';
-      if(items.length === 0){
-        container.innerHTML = '<div class="row" style="justify-content:center;color:var(--muted)">No visits yet — refresh the page.</div>';
-      }else{
-        items.slice(0, 14).forEach(v=>{
-          const [t, d] = fmtDate(v.created_date);
-          const ip = v.ip_address ? v.ip_address : 'Unknown IP';
-          const idx = (list.total || 0) - (v.count_after || 0) + 1;
-          container.insertAdjacentHTML('beforeend', `
-            <div class="row">
-              <div style="display:flex;align-items:center;gap:12px">
-                <div style="width:36px;height:36px;border-radius:999px;background:var(--chip-blue-bg);color:var(--chip-blue);display:flex;align-items:center;justify-content:center">
-                  <svg width="18" height="18" viewBox="0 0 24 24" fill="none"><path d="M12 12a5 5 0 1 0 0-10 5 5 0 0 0 0 10Z" stroke="currentColor" stroke-width="2"/><path d="M2 22a10 10 0 0 1 20 0" stroke="currentColor" stroke-width="2"/></svg>
-                </div>
-                <div>
-                  <div style="font-weight:600">Page Visit #${idx}</div>
-                  <div class="ip"><svg width="12" height="12" viewBox="0 0 24 24" fill="currentColor"><path d="M12 2a10 10 0 1 0 0 20 10 10 0 0 0 0-20Zm0 4a6 6 0 1 1 0 12A6 6 0 0 1 12 6Z"/></svg>${ip}</div>
-                </div>
-              </div>
-              <div style="text-align:right">
-                <div style="font-weight:600">${t}</div>
-                <div class="muted" style="font-size:12px">${d}</div>
-              </div>
-            </div>
-          `);
-        });
-      }
-    }
-
-    // Increment button (AJAX)
-    const btn = document.getElementById('btn-visit');
-    btn.addEventListener('click', async ()=>{
-      btn.disabled = True;
-      try{
-        await j('/api/incr', { method:'POST' });
-        await loadState();
-      } finally { btn.disabled = False; }
-    });
-
-    // Initial load (server already incremented on render)
-    loadState();
-    setInterval(loadState, 30000);
-  </script>
+  <script src="{{ assets.theme_js }}"></script>
+  <script src="{{ assets.dashboard_js }}"></script>
 </body>
 </html>
 """
@@ -449,7 +2089,7 @@ ANALYTICS_HTML = """
   <script src="https://cdn.tailwindcss.com"></script>
   <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;600;800&display=swap" rel="stylesheet">
   <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
-  {{ base_css|safe }}
+  <link href="{{ assets.base_css }}" rel="stylesheet">
 </head>
 <body>
   <div class="container">
@@ -475,75 +2115,161 @@ ANALYTICS_HTML = """
     </div>
   </div>
 
-  <script>
-    function setTheme(mode){
-      document.documentElement.setAttribute('data-theme', mode);
-      localStorage.setItem('sitescope_theme', mode);
-    }
-    (function(){ setTheme(localStorage.getItem('sitescope_theme') || 'dark'); })();
-    document.getElementById('theme-dark').addEventListener('click', ()=>setTheme('dark'));
-    document.getElementById('theme-light').addEventListener('click', ()=>setTheme('light'));
-
-    let dailyChart, hourlyChart;
-    async function j(u){ const r = await fetch(u); return r.json(); }
-
-    async function load(){
-      const st = await j('/api/state');
-      const vis = await j('/api/visits?limit=2000');
-      const an = await j('/api/analytics');
-
-      document.getElementById('stat-total').textContent = st.count || 0;
-      const todayStr = new Date().toDateString();
-      const todayCount = (vis.items||[]).filter(v => new Date(v.created_date).toDateString() === todayStr).length;
-      document.getElementById('stat-today').textContent = todayCount;
-
-      const dCtx = document.getElementById('dailyChart').getContext('2d');
-      if(dailyChart) dailyChart.destroy();
-      dailyChart = new Chart(dCtx, {
-        type: 'bar',
-        data: { labels: (an.daily||[]).map(x=>x.date), datasets: [{ label: 'Visits', data: (an.daily||[]).map(x=>x.visits) }] },
-        options: {
-          responsive:true,
-          scales:{ x:{ ticks:{color:getComputedStyle(document.documentElement).getPropertyValue('--muted')}, grid:{color:'rgba(148,163,184,.25)'} }, y:{ beginAtZero:true, ticks:{color:getComputedStyle(document.documentElement).getPropertyValue('--muted')}, grid:{color:'rgba(148,163,184,.25)'} } },
-          plugins:{ legend:{ labels:{ color:getComputedStyle(document.documentElement).getPropertyValue('--muted') } } }
-        }
-      });
-
-      const hCtx = document.getElementById('hourlyChart').getContext('2d');
-      if(hourlyChart) hourlyChart.destroy();
-      hourlyChart = new Chart(hCtx, {
-        type: 'line',
-        data: { labels: (an.hourly||[]).map(x=>x.hour), datasets: [{ label:'Visits', data:(an.hourly||[]).map(x=>x.visits) }] },
-        options: {
-          responsive:true,
-          scales:{ x:{ ticks:{color:getComputedStyle(document.documentElement).getPropertyValue('--muted')}, grid:{color:'rgba(148,163,184,.25)'} }, y:{ beginAtZero:true, ticks:{color:getComputedStyle(document.documentElement).getPropertyValue('--muted')}, grid:{color:'rgba(148,163,184,.25)'} } },
-          plugins:{ legend:{ labels:{ color:getComputedStyle(document.documentElement).getPropertyValue('--muted') } } }
-        }
-      });
-    }
-    load();
-  </script>
+  <script src="{{ assets.theme_js }}"></script>
+  <script src="{{ assets.analytics_js }}"></script>
 </body>
 </html>
 """
 
+# --- Static assets & pre-rendered pages ---
+# CSS/JS are served from memory under content-hashed names, so browsers may
+# cache them forever. Pages without per-request data are rendered once at
+# import; the dashboard template is compiled once. Bodies built at import
+# are compressed once (gzip, and br when brotli is installed).
+ASSET_MAX_AGE = "public, max-age=31536000, immutable"
+
+class Payload:
+    """A response body with its ETag and precompressed variants."""
+
+    def __init__(self, body, mimetype):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(body).hexdigest()[:16]
+        self.encoded = {"gzip": gzip.compress(body, 9)}
+        if brotli is not None:
+            self.encoded["br"] = brotli.compress(body, quality=11)
+
+    def pick(self, accept_encodings):
+        """(Content-Encoding or None, body) for the client's Accept-Encoding."""
+        for enc in ("br", "gzip"):
+            if enc in self.encoded and accept_encodings[enc]:
+                return enc, self.encoded[enc]
+        return None, self.body
+
+def compress(body, accept_encodings):
+    """On-the-fly gzip for per-request bodies."""
+    if len(body) >= 1024 and accept_encodings["gzip"]:
+        return "gzip", gzip.compress(body, 6)
+    return None, body
+
+ASSETS = {}   # fingerprinted file name -> Payload
+
+def add_asset(name, text, mimetype):
+    stem, ext = name.rsplit(".", 1)
+    p = Payload(text.encode(), mimetype)
+    ASSETS[f"{stem}.{p.etag[:10]}.{ext}"] = p
+    return f"/assets/{stem}.{p.etag[:10]}.{ext}"
+
+ASSET_URLS = {
+    "base_css": add_asset("sitescope.css", BASE_CSS, "text/css"),
+    "theme_js": add_asset("theme.js", THEME_JS, "text/javascript"),
+    "dashboard_js": add_asset("dashboard.js", DASHBOARD_JS, "text/javascript"),
+    "analytics_js": add_asset("analytics.js", ANALYTICS_JS, "text/javascript"),
+}
+
+_jinja = Environment(autoescape=True)
+DASHBOARD_TEMPLATE = _jinja.from_string(DASHBOARD_HTML)
+LANDING_PAGE = Payload(_jinja.from_string(LANDING_HTML).render(name=APP_NAME, assets=ASSET_URLS).encode(),
+                       "text/html")
+ANALYTICS_PAGE = Payload(_jinja.from_string(ANALYTICS_HTML).render(name=APP_NAME, assets=ASSET_URLS).encode(),
+                         "text/html")
+
+def encoded_response(enc, body, mimetype):
+    resp = Response(body, mimetype=mimetype)
+    if enc:
+        resp.headers["Content-Encoding"] = enc
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+def send_payload(p, cache_control):
+    if p.etag in request.if_none_match:
+        resp = Response(status=304)
+    else:
+        resp = encoded_response(*p.pick(request.accept_encodings), p.mimetype)
+    resp.set_etag(p.etag)
+    resp.headers["Cache-Control"] = cache_control
+    resp.vary.add("Accept-Encoding")
+    return resp
+
 # --- Routes ---
-@app.route("/")
+@bp.route("/assets/<name>")
+def asset(name):
+    p = ASSETS.get(name)
+    if p is None:
+        abort(404)
+    return send_payload(p, ASSET_MAX_AGE)
+
+@bp.route("/")
 def home():  # thumbnail landing; does NOT increment
-    return render_template_string(LANDING_HTML, name=APP_NAME, base_css=BASE_CSS)
+    return send_payload(LANDING_PAGE, "no-cache")
 
-@app.route("/count")
+@bp.route("/count")
 def count_page():  # full dashboard; increments on refresh
-    ip = request.headers.get("X-Forwarded-For", request.remote_addr or "unknown")
+    ip = request.remote_addr or "unknown"
     ua = request.headers.get("User-Agent", "unknown")
     count_after, _ = create_visit(ip, ua)
-    return render_template_string(DASHBOARD_HTML, name=APP_NAME, base_css=BASE_CSS, count=count_after)
+    html = DASHBOARD_TEMPLATE.render(name=APP_NAME, assets=ASSET_URLS, count=count_after).encode()
+    return encoded_response(*compress(html, request.accept_encodings), "text/html")
 
-@app.route("/analytics")
+@bp.route("/analytics")
 def analytics():
-    return render_template_string(ANALYTICS_HTML, name=APP_NAME, base_css=BASE_CSS)
+    return send_payload(ANALYTICS_PAGE, "no-cache")
+
+@bp.route("/metrics")
+def metrics_page():
+    if metrics is None:
+        abort(404)
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+def start_timer():
+    request.environ["vc.t0"] = time.perf_counter()
+
+def record_request(resp):
+    route = request.url_rule.rule if request.url_rule else "<unmatched>"
+    metrics.request_seconds.labels(route, request.method).observe(
+        time.perf_counter() - request.environ["vc.t0"])
+    metrics.requests.labels(route, str(resp.status_code)).inc()
+    if not resp.is_streamed:
+        metrics.response_bytes.labels(route).observe(resp.calculate_content_length() or 0)
+    stats = pool_stats()
+    metrics.pool.labels("in_use").set(stats["in_use"])
+    metrics.pool.labels("idle").set(stats["idle"])
+    metrics.breaker_open.set(breaker.state == "open")
+    return resp
+
+# --- App ---
+def create_app():
+    """Application factory: `gunicorn -c gunicorn.conf.py "count:create_app()"`."""
+    app = Flask(__name__)
+    if PROXY_HOPS:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
+    app.register_blueprint(bp)
+    if metrics is not None:
+        app.before_request(start_timer)
+        app.after_request(record_request)
+    for s in SHARDS:
+        try:
+            s.client.setnx(s.count, 0)
+        except redis.RedisError as e:
+            # Not fatal: INCRBY creates the key on the first visit.
+            app.logger.warning("could not initialise %s: %s", s.count, e)
+    get_spool()   # starts replaying files left by earlier workers
+    return app
+
+def shutdown():
+    """Graceful stop for a worker: drain the write-behind buffer, fsync the spool."""
+    global _buffer, _spool
+    with _buffer_lock:
+        buf, _buffer = _buffer, None
+    if buf is not None:
+        buf.close()
+    with _spool_lock:
+        spool, _spool = _spool, None
+    if spool is not None:
+        spool.close()
 
 # --- Main ---
 if __name__ == "__main__":
-    r.setnx(K_VISIT_COUNT, 0)
-    app.run(host="0.0.0.0", port=5002)
\ No newline at end of file
+    # Development server only; see gunicorn.conf.py for production.
+    create_app().run(host="0.0.0.0", port=5002, threaded=True)
\ No newline at end of file
@@ -0,0 +1,370 @@
+"""Asyncio variant of SiteScope: the same routes, key schema and Lua scripts
+as count.py, on Quart + redis.asyncio.
+
+    pip install quart uvicorn
+    uvicorn count_async:app --host 0.0.0.0 --port 5002 --workers 4
+
+Behind a proxy add `--forwarded-allow-ips <proxy address>` so uvicorn takes
+the client address from X-Forwarded-For.
+
+The write-behind buffer and response cache are sync-only; everything here
+talks to Redis through one bounded async pool per worker, configured from
+the same env vars as count.py (the circuit breaker is sync-only too).
+"""
+import asyncio
+from contextlib import suppress
+
+import redis.asyncio as aioredis
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
+from quart import Quart, Response, abort, jsonify, request
+
+from count import (
+    ANALYTICS_MAX_DAYS, ANALYTICS_PAGE, APP_NAME, ASSETS, ASSET_MAX_AGE,
+    ASSET_URLS, CH_VISITS, DASHBOARD_TEMPLATE, INGEST_LUA, INTERN_UA_LUA, K_DAY,
+    K_UA_IDS, K_UA_NAMES, K_UA_SEQ, K_VISITS_LIST, K_VISITS_STREAM,
+    K_VISIT_COUNT, LANDING_PAGE, NDJSON, RANGE_MAX, REDIS_BACKOFF_BASE,
+    REDIS_BACKOFF_CAP, REDIS_RETRIES, SHARDS, SSE_CLIENT_BACKLOG, SSE_HEARTBEAT,
+    SSE_MAX_CLIENTS, STREAM_THRESHOLD, UA_DICT_MAX, VISITS_CAP, _ua_ids,
+    _ua_names, analytics_commands, analytics_result, analytics_window,
+    assign_counts, compress, guard, ingest_command, json_chunk, json_head,
+    json_items, missing_ua_ids, new_doc, next_chunk, parse_for_json,
+    parse_frames, parse_record, pool_stats, range_bounds, range_page,
+    redis_options, remember_ua, sse_frame, today_key, top_ua_ids, visit_dict,
+)
+
+if len(SHARDS) > 1:
+    raise RuntimeError("count_async does not support VC_SHARDS > 1; use count.py")
+
+# --- Quart & Redis ---
+app = Quart(__name__)
+pool = aioredis.BlockingConnectionPool(
+    retry=Retry(ExponentialBackoff(cap=REDIS_BACKOFF_CAP, base=REDIS_BACKOFF_BASE), REDIS_RETRIES),
+    **redis_options())
+r = aioredis.Redis(connection_pool=pool)
+ingest_script = r.register_script(INGEST_LUA)
+intern_ua_script = r.register_script(INTERN_UA_LUA)
+
+# --- Helpers ---
+async def get_total_count():
+    val = await r.get(K_VISIT_COUNT)
+    return int(val) if val else 0
+
+async def intern_ua(ua):
+    ua_id = _ua_ids.get(ua)
+    if ua_id is None:
+        ua_id = int(await intern_ua_script(keys=[K_UA_IDS, K_UA_NAMES, K_UA_SEQ], args=[ua, UA_DICT_MAX],
+                                           client=r))
+        remember_ua(ua, ua_id)
+    return ua_id
+
+async def resolve_uas(parsed):
+    await load_ua_names(missing_ua_ids(parsed))
+
+async def load_ua_names(ids):
+    missing = sorted({i for i in ids if i not in _ua_names})
+    if missing:
+        for ua_id, name in zip(missing, await r.hmget(K_UA_NAMES, missing)):
+            if name is not None:
+                remember_ua(name.decode("utf-8", "replace"), ua_id)
+
+async def decode_visits(raws):
+    parsed = [parse_record(x) for x in raws]
+    await resolve_uas(parsed)
+    return [visit_dict(p, _ua_names) for p in parsed]
+
+async def list_visits(limit=100):
+    raw = await r.lrange(K_VISITS_LIST, 0, max(1, min(int(limit), VISITS_CAP)) - 1)
+    return await decode_visits(raw)
+
+async def iter_visits_json(total, limit, ndjson=False):
+    # Same chunking as count.iter_visits_json.
+    yield json_head(ndjson, total)
+    top, next_count, left, first = total, total, limit, True
+    while left > 0 and next_count > 0:
+        async with r.pipeline(transaction=True) as pipe:
+            pipe.get(K_VISIT_COUNT)
+            pipe.lrange(K_VISITS_LIST, *next_chunk(top, next_count, left))
+            now, raw = await pipe.execute()
+        shift, top = int(now or 0) - top, int(now or 0)
+        raw = raw[max(0, shift):]
+        if not raw:
+            if shift == 0:
+                break
+            continue
+        parsed = parse_for_json(raw)
+        await resolve_uas(parsed)
+        yield json_chunk(json_items(parsed), ndjson, first)
+        first = False
+        next_count -= len(raw)
+        left -= len(raw)
+    if not ndjson:
+        yield b"]}"
+
+async def list_visits_since(since, total, limit=100):
+    n = min(max(0, total - since), limit)
+    if n == 0:
+        return []
+    return [v for v in await list_visits(n) if v.get("count_after", 0) > since]
+
+async def list_visits_range(starts, end, limit=100):
+    entries = await r.xrange(K_VISITS_STREAM, starts[0], end, count=limit)
+    return range_page([eid.decode() for eid, _ in entries],
+                      await decode_visits([fields[b"r"] for _, fields in entries]), limit)
+
+async def create_visit(ip, ua):
+    doc = new_doc(ip, ua)
+    verdict = guard.check(doc) if guard is not None else None
+    if verdict is None:
+        # Guarded, an unknown user agent goes out inline and is interned only once accepted.
+        ua = doc["user_agent"]
+        ua_id = await intern_ua(ua) if guard is None else _ua_ids.get(ua, 0)
+        keys, args = ingest_command([doc], [ua_id])
+        n = await ingest_script(keys=keys, args=args, client=r)
+        if isinstance(n, list):   # turned away by the ingest guard
+            guard.rejected(doc, n[0])
+            verdict = doc.pop("guard")
+        else:
+            if guard is not None:
+                guard.accepted(doc)
+                if ua not in _ua_ids:
+                    with suppress(aioredis.RedisError):   # best effort: the visit is written
+                        await intern_ua(ua)
+            assign_counts([doc], n)
+    if verdict == "dropped":
+        abort(429)
+    if verdict == "deduped":
+        doc["deduped"] = True
+        return await get_total_count(), doc
+    return doc["count_after"], doc
+
+def client_info():
+    ip = request.remote_addr or "unknown"
+    return ip, request.headers.get("User-Agent", "unknown")
+
+def parse_limit(default=100):
+    try:
+        return max(1, min(int(request.args.get("limit", default)), VISITS_CAP))
+    except Exception:
+        return default
+
+def bad_request(msg):
+    return jsonify({"ok": False, "error": msg}), 400
+
+def tagged(resp, tag):
+    resp.set_etag(tag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+class Broadcaster:
+    """One pub/sub subscription per worker, fanned out to asyncio queues."""
+
+    def __init__(self):
+        self.clients = set()
+        self.task = None
+
+    def full(self):
+        return len(self.clients) >= SSE_MAX_CLIENTS
+
+    def add(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._run())
+        if self.full():
+            return None
+        q = asyncio.Queue(maxsize=SSE_CLIENT_BACKLOG)
+        self.clients.add(q)
+        return q
+
+    def remove(self, q):
+        self.clients.discard(q)
+
+    async def _run(self):
+        backoff = 0.5
+        while True:
+            try:
+                ps = r.pubsub(ignore_subscribe_messages=True)
+                await ps.subscribe(CH_VISITS)
+                backoff = 0.5
+                while True:
+                    msg = await ps.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if msg is None:
+                        continue
+                    docs = await decode_visits(parse_frames(msg["data"]))
+                    events = [(d["count_after"], sse_frame(d)) for d in docs]
+                    for q in list(self.clients):
+                        try:
+                            q.put_nowait(events)
+                        except asyncio.QueueFull:
+                            # Too slow: end its stream; the browser reconnects with Last-Event-ID.
+                            self.remove(q)
+                            q.dropped = True
+            except Exception:
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 10)
+
+broadcaster = Broadcaster()
+
+# --- Lifecycle ---
+@app.before_serving
+async def init():
+    await r.setnx(K_VISIT_COUNT, 0)
+
+@app.after_serving
+async def close():
+    await pool.disconnect()
+
+# --- API ---
+@app.route("/api/state")
+async def api_state():
+    return jsonify({"name": APP_NAME, "count": await get_total_count()})
+
+@app.route("/api/health")
+async def api_health():
+    return jsonify({"pool": pool_stats(pool)})
+
+@app.route("/api/visits")
+async def api_visits():
+    if any(request.args.get(k) for k in ("from", "to", "cursor")):
+        try:
+            starts, end = range_bounds(request.args)
+        except ValueError:
+            return bad_request("from/to must be epoch ms or ISO 8601, cursor a stream id")
+        return jsonify(await list_visits_range(starts, end, parse_limit(default=RANGE_MAX)))
+    n = parse_limit()
+    since = request.args.get("since", type=int)
+    ndjson = (request.accept_mimetypes.best_match(["application/json", NDJSON]) == NDJSON
+              or request.args.get("format") == "ndjson")
+    if since is None and (ndjson or n > STREAM_THRESHOLD):
+        total = await get_total_count()
+        tag = f"{total}-ndjson" if ndjson else str(total)   # negotiated on Accept, see Vary
+        if tag in request.if_none_match:
+            resp = tagged(Response("", status=304), tag)
+        else:
+            resp = tagged(Response(iter_visits_json(total, n, ndjson),
+                                   mimetype=NDJSON if ndjson else "application/json"), tag)
+        resp.vary.add("Accept")
+        return resp
+    if since is None:
+        # Independent reads go out concurrently on separate pool connections.
+        total, items = await asyncio.gather(get_total_count(), list_visits(n))
+    else:
+        total = await get_total_count()
+        items = await list_visits_since(since, total, n)
+    tag = str(total)
+    if tag in request.if_none_match:
+        resp = tagged(Response("", status=304), tag)
+    else:
+        resp = tagged(jsonify({"items": items, "total": total}), tag)
+    resp.vary.add("Accept")
+    return resp
+
+@app.route("/api/summary")
+async def api_summary():
+    n = parse_limit(default=14)
+    day = today_key()
+    total, today, raw = await asyncio.gather(
+        get_total_count(), r.get(day), r.lrange(K_VISITS_LIST, 0, n - 1))
+    tag = f"{total}-{day[len(K_DAY):]}"
+    if tag in request.if_none_match:
+        return tagged(Response("", status=304), tag)
+    return tagged(jsonify({"total": total, "day": day[len(K_DAY):], "today": int(today or 0),
+                           "items": await decode_visits(raw)}), tag)
+
+@app.route("/api/analytics")
+async def api_analytics():
+    try:
+        first, last = analytics_window(request.args)
+    except ValueError:
+        return bad_request(f"from/to must be YYYY-MM-DD, at most {ANALYTICS_MAX_DAYS} days apart")
+    pipe = r.pipeline(transaction=False)
+    labels = analytics_commands(pipe, first, last)
+    results = await pipe.execute()
+    await load_ua_names(top_ua_ids(results))
+    return jsonify(analytics_result(labels, results))
+
+@app.route("/api/stream")
+async def api_stream():
+    # The client is registered in gen(): a body that is never iterated (HEAD, an early
+    # disconnect) never runs its cleanup.
+    if broadcaster.full():
+        return jsonify({"ok": False, "error": "too many stream clients"}), 503
+    if request.method == "HEAD":
+        return Response(b"", mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+    last = request.headers.get("Last-Event-ID", request.args.get("last_id", ""))
+    last = int(last) if last.isdigit() else None
+
+    async def gen():
+        q = broadcaster.add()
+        if q is None:
+            return
+        try:
+            seen = last
+            yield b"retry: 3000\n\n"
+            if last is not None:
+                for doc in reversed(await list_visits_since(last, await get_total_count(), VISITS_CAP)):
+                    seen = doc["count_after"]
+                    yield sse_frame(doc).encode()
+            while True:
+                try:
+                    events = await asyncio.wait_for(q.get(), SSE_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield b": ping\n\n"
+                    continue
+                if getattr(q, "dropped", False):
+                    return
+                for count_after, frame in events:
+                    if seen is None or count_after > seen:
+                        seen = count_after
+                        yield frame.encode()
+        finally:
+            broadcaster.remove(q)
+
+    resp = Response(gen(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    resp.timeout = None
+    return resp
+
+@app.route("/api/incr", methods=["POST", "GET"])
+async def api_incr():
+    count_after, doc = await create_visit(*client_info())
+    return jsonify({"ok": True, "count": count_after, "visit": doc})
+
+# --- Routes ---
+def encoded_response(enc, body, mimetype):
+    resp = Response(body, mimetype=mimetype)
+    if enc:
+        resp.headers["Content-Encoding"] = enc
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+def send_payload(p, cache_control):
+    if p.etag in request.if_none_match:
+        resp = Response("", status=304)
+    else:
+        resp = encoded_response(*p.pick(request.accept_encodings), p.mimetype)
+    resp.set_etag(p.etag)
+    resp.headers["Cache-Control"] = cache_control
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+@app.route("/assets/<name>")
+async def asset(name):
+    p = ASSETS.get(name)
+    if p is None:
+        abort(404)
+    return send_payload(p, ASSET_MAX_AGE)
+
+@app.route("/")
+async def home():
+    return send_payload(LANDING_PAGE, "no-cache")
+
+@app.route("/count")
+async def count_page():
+    count_after, _ = await create_visit(*client_info())
+    html = DASHBOARD_TEMPLATE.render(name=APP_NAME, assets=ASSET_URLS, count=count_after).encode()
+    return encoded_response(*compress(html, request.accept_encodings), "text/html")
+
+@app.route("/analytics")
+async def analytics():
+    return send_payload(ANALYTICS_PAGE, "no-cache")
@@ -0,0 +1,51 @@
+"""Gunicorn settings for SiteScope, read from the environment.
+
+    gunicorn -c gunicorn.conf.py "count:create_app()"
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5002')}"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 20))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 10
+accesslog = "-" if os.getenv("GUNICORN_ACCESS_LOG") else None
+
+# Every SSE stream pins a gthread thread for as long as the browser stays open.
+# Cap streams at a quarter of the threads so pages and /api/incr keep the rest;
+# past the cap /api/stream answers 503 and the dashboard falls back to polling.
+# Under docker-compose nginx sends /api/stream to the async `stream` service instead.
+os.environ.setdefault("VC_SSE_MAX_CLIENTS", str(max(1, threads // 4)))
+
+# With VC_METRICS=1 each worker writes its Prometheus samples under this directory;
+# set here, before the workers import count.py, so every worker sees it.
+if os.getenv("VC_METRICS") == "1":
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/sitescope-metrics")
+
+
+def on_starting(server):
+    # Samples left by a previous master would be summed into the new ones.
+    path = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            if name.endswith(".db"):
+                os.remove(os.path.join(path, name))
+
+
+def worker_exit(server, worker):
+    # Flush visits still queued in write-behind mode before the worker goes away.
+    import count
+    count.shutdown()
+
+
+def child_exit(server, worker):
+    # Drop the dead worker's live gauges (pool connections, breaker) from /metrics.
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
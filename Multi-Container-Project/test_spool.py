@@ -0,0 +1,151 @@
+"""Fallback spool: visits written while Redis is down are replayed exactly once.
+
+    pip install pytest fakeredis lupa
+    python -m pytest test_spool.py
+"""
+import json
+import os
+import threading
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")   # fakeredis needs it for the Lua scripts
+
+import count
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """count.py on a fakeredis server, spooling to tmp_path; replays only when a test calls replay()."""
+    server = fakeredis.FakeServer()
+    client = fakeredis.FakeRedis(server=server)
+    monkeypatch.setattr(count, "r", client)
+    monkeypatch.setattr(count, "SHARDS", [count.Shard(0, client, "vc:")])
+    monkeypatch.setattr(count, "_shard_counts", [0])
+    monkeypatch.setattr(count, "_last_count", 0)
+    monkeypatch.setattr(count, "_ua_ids", {})     # ids cached from another test's server
+    monkeypatch.setattr(count, "_ua_names", {})
+    monkeypatch.setattr(count, "guard", None)
+    monkeypatch.setattr(count, "INGEST_MODE", "sync")
+    monkeypatch.setattr(count, "SPOOL_DIR", str(tmp_path))
+    monkeypatch.setattr(count, "SPOOL_REPLAY_INTERVAL", 3600)
+    monkeypatch.setattr(count, "_spool", None)
+    yield server
+    if count._spool is not None:
+        count._spool.close()
+
+
+def stored_visits(server):
+    client = fakeredis.FakeRedis(server=server)
+    entries = client.xrange(count.K_VISITS_STREAM)
+    return int(client.get(count.K_VISIT_COUNT) or 0), count.decode_visits([f[b"r"] for _, f in entries])
+
+
+def visit(i, ua="pytest/1.0"):
+    return count.create_visit(f"10.0.{i // 250}.{i % 250}", ua)[1]
+
+
+def test_outage_spools_and_replays_in_order(server, tmp_path):
+    for i in range(10):
+        visit(i)
+    server.connected = False
+    spooled = [visit(i) for i in range(10, 60)]   # must not raise while Redis is down
+    spool = count.get_spool()
+    spool.sync()
+    assert len(os.listdir(tmp_path)) == 1
+
+    server.connected = True
+    assert spool.replay() == 50
+    assert spool.replay() == 0
+    assert os.listdir(tmp_path) == []
+
+    total, visits = stored_visits(server)
+    assert total == len(visits) == 60
+    assert sorted(v["count_after"] for v in visits) == list(range(1, 61))
+    replayed = {(v["created_date"], v["ip_address"]): v["count_after"] for v in visits}
+    ours = [replayed[(d["created_date"], d["ip_address"])] for d in spooled]
+    assert ours == sorted(ours)
+
+
+def test_torn_last_line_is_not_replayed(server, tmp_path):
+    visit(0)
+    # A dead worker's file: three whole lines, then one cut short by the crash.
+    path = tmp_path / "0-1-1.spool"
+    lines = [json.dumps(count.new_doc(f"10.9.0.{i}", "dead/1.0")) + "\n" for i in range(3)]
+    path.write_text("".join(lines) + '{"created_date":"20')
+    os.utime(path, (0, 0))   # idle long enough to be removed once drained
+
+    assert count.get_spool().replay() == 3
+    assert not path.exists()
+    total, visits = stored_visits(server)
+    assert total == len(visits) == 4
+    assert sorted(v["ip_address"] for v in visits if v["user_agent"] == "dead/1.0") == \
+        ["10.9.0.0", "10.9.0.1", "10.9.0.2"]
+
+
+def test_concurrent_replayers_write_each_visit_once(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(count, "SPOOL_BATCH", 25)   # many small batches: replayers race on every one
+    server.connected = False
+    n = 1000
+    for i in range(n):
+        visit(i)
+    spool = count.get_spool()
+    spool.sync()
+    server.connected = True
+
+    done = [0] * 4
+
+    def replayer(t):
+        done[t] = spool.replay()
+
+    threads = [threading.Thread(target=replayer, args=(t,)) for t in range(len(done))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sum(done) == n
+    assert spool.replay() == 0
+    assert os.listdir(tmp_path) == []
+    total, visits = stored_visits(server)
+    assert total == len(visits) == n
+    assert sorted(v["count_after"] for v in visits) == list(range(1, n + 1))
+
+
+def time_out_after_commit(monkeypatch, client, retry):
+    """The next EVALSHA runs, then its reply is lost; retry re-sends it like redis-py does."""
+    evalsha = client.evalsha
+
+    def lost_reply(*args):
+        monkeypatch.setattr(client, "evalsha", evalsha)
+        evalsha(*args)
+        if retry:
+            return evalsha(*args)
+        raise count.redis.TimeoutError("Timeout reading from socket")
+
+    monkeypatch.setattr(client, "evalsha", lost_reply)
+
+
+def test_retry_after_commit_counts_once(server, monkeypatch):
+    visit(0)
+    time_out_after_commit(monkeypatch, count.SHARDS[0].client, retry=True)
+    assert visit(1)["count_after"] == 2
+    total, visits = stored_visits(server)
+    assert total == len(visits) == 2
+
+
+def test_spooled_call_that_committed_is_not_replayed(server, tmp_path, monkeypatch):
+    visit(0)
+    time_out_after_commit(monkeypatch, count.SHARDS[0].client, retry=False)
+    visit(1)   # committed, but the worker only saw the timeout and spooled it
+    visit(2)
+    spool = count.get_spool()
+    spool.sync()
+    assert len(os.listdir(tmp_path)) == 1
+
+    spool.replay()
+    assert os.listdir(tmp_path) == []
+    total, visits = stored_visits(server)
+    assert total == len(visits) == 3
+    assert sorted(v["ip_address"] for v in visits) == ["10.0.0.0", "10.0.0.1", "10.0.0.2"]
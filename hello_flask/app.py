@@ -1,23 +1,214 @@
 # app.py
 
-from flask import Flask
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Flask, g, jsonify
 import MySQLdb
 
 app = Flask(__name__)
 
+# --- MySQL settings (env) ---
+DB_CONFIG = dict(
+    host=os.getenv("MYSQL_HOST", "mydb"),           # Hostname of the MySQL container
+    user=os.getenv("MYSQL_USER", "root"),           # Username to connect to MySQL
+    passwd=os.getenv("MYSQL_PASSWORD", ""),         # Password for the MySQL user
+    db=os.getenv("MYSQL_DATABASE", "mysql"),        # Name of the database to connect to
+    port=int(os.getenv("MYSQL_PORT", 3306)),
+    connect_timeout=int(os.getenv("MYSQL_CONNECT_TIMEOUT", 5)),
+)
+POOL_SIZE = int(os.getenv("MYSQL_POOL_SIZE", 10))            # 0 = connect per request (no pool)
+POOL_MAX_IDLE = float(os.getenv("MYSQL_POOL_MAX_IDLE_S", 300))
+POOL_TIMEOUT = float(os.getenv("MYSQL_POOL_TIMEOUT_S", 5))
+CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", 256))
+VERSION_TTL = float(os.getenv("QUERY_CACHE_VERSION_TTL_S", 3600))   # server version only changes on restart
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class ConnectionPool:
+    """A fixed-size pool of MySQL connections.
+
+    Connections are opened lazily up to `size`. On checkout, a connection idle
+    for longer than `max_idle` seconds is replaced, and any other is pinged
+    (reconnecting if the server dropped it) before it is handed out.
+    """
+
+    def __init__(self, size, max_idle, timeout, **connect_args):
+        self.size = size
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.connect_args = connect_args
+        self.idle = queue.LifoQueue()   # (connection, returned_at); LIFO keeps hot connections hot
+        self.slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        return MySQLdb.connect(**self.connect_args)
+
+    def get(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise PoolExhausted(f"no MySQL connection free within {self.timeout}s")
+        try:
+            while True:
+                try:
+                    conn, returned_at = self.idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if time.monotonic() - returned_at > self.max_idle:
+                    self._close(conn)
+                    continue
+                try:
+                    conn.ping()
+                    return conn
+                except MySQLdb.Error:
+                    self._close(conn)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def put(self, conn, broken=False):
+        if broken:
+            self._close(conn)
+        else:
+            try:
+                conn.rollback()     # never hand out a connection mid-transaction
+                self.idle.put((conn, time.monotonic()))
+            except MySQLdb.Error:
+                self._close(conn)
+        self.slots.release()
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+
+
+pool = ConnectionPool(POOL_SIZE, POOL_MAX_IDLE, POOL_TIMEOUT, **DB_CONFIG) if POOL_SIZE > 0 else None
+
+
+def get_db():
+    """The request's MySQL connection, checked out on first use."""
+    if "db" not in g:
+        g.db = pool.get() if pool else MySQLdb.connect(**DB_CONFIG)
+    return g.db
+
+
+@app.teardown_appcontext
+def release_db(exc):
+    db = g.pop("db", None)
+    if db is None:
+        return
+    if pool:
+        pool.put(db, broken=isinstance(exc, MySQLdb.OperationalError))
+    else:
+        db.close()
+
+
+class _Flight:
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class QueryCache:
+    """Read-through cache for query results.
+
+    Keeps at most `max_entries` results in LRU order; each expires `ttl`
+    seconds after it was loaded (None = only evicted by LRU). Concurrent
+    misses on the same key share a single load (single flight).
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()    # key -> (expires_at or None, value)
+        self.inflight = {}              # key -> _Flight
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.coalesced = self.evictions = 0
+
+    def get(self, key, load, ttl=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                self.misses += 1
+                flight = self.inflight[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = load()
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            with self.lock:
+                self.entries[key] = (None if ttl is None else time.monotonic() + ttl, flight.value)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight.done.set()
+        return flight.value
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "max_entries": self.max_entries, "hits": self.hits,
+                    "misses": self.misses, "coalesced": self.coalesced, "evictions": self.evictions}
+
+
+cache = QueryCache(CACHE_MAX_ENTRIES)
+
+
+def cached_query(sql, args=(), ttl=60):
+    """Rows for sql/args, served from the cache; only a miss touches MySQL."""
+    def load():
+        cur = get_db().cursor()
+        try:
+            cur.execute(sql, args or None)
+            return cur.fetchall()
+        finally:
+            cur.close()
+    return cache.get((sql, tuple(args)), load, ttl)
+
+
 @app.route('/')
 def hello_world():
-    # Connect to the MySQL database
-    db = MySQLdb.connect(
-        host="mydb",    # Hostname of the MySQL container
-        user="root",    # Username to connect to MySQL
-        passwd="my-secret-pw",  # Password for the MySQL user
-        db="mysql"      # Name of the database to connect to
-    )
-    cur = db.cursor()
-    cur.execute("SELECT VERSION()")
-    version = cur.fetchone()
+    version = cached_query("SELECT VERSION()", ttl=VERSION_TTL)[0]
     return f'Hello, World! MySQL version: {version[0]}'
 
+
+@app.route('/cache')
+def cache_stats():
+    return jsonify(cache.stats())
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5002)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5002)
@@ -0,0 +1,55 @@
+"""Tiny HTTP load generator for hello_flask.
+
+Compare connect-per-request with the pool by starting the app twice:
+
+    MYSQL_POOL_SIZE=0  python app.py &    # before: new MySQL connection per hit
+    python loadtest.py --url http://localhost:5002/ -c 20 --duration 15
+    MYSQL_POOL_SIZE=10 python app.py &    # after: pooled connections
+    python loadtest.py --url http://localhost:5002/ -c 20 --duration 15
+"""
+import argparse
+import threading
+import time
+import urllib.request
+
+
+def worker(url, deadline, samples, errors):
+    while time.perf_counter() < deadline:
+        t0 = time.perf_counter()
+        try:
+            with urllib.request.urlopen(url, timeout=10) as resp:
+                resp.read()
+            samples.append(time.perf_counter() - t0)
+        except Exception:
+            errors.append(1)
+
+
+def pct(s, p):
+    return s[min(len(s) - 1, int(round(p / 100.0 * (len(s) - 1))))]
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--url", default="http://localhost:5002/")
+    p.add_argument("-c", "--concurrency", type=int, default=20)
+    p.add_argument("--duration", type=float, default=10)
+    args = p.parse_args()
+
+    samples, errors = [], []
+    deadline = time.perf_counter() + args.duration
+    threads = [threading.Thread(target=worker, args=(args.url, deadline, samples, errors))
+               for _ in range(args.concurrency)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+
+    s = sorted(samples) or [0.0]
+    print(f"c={args.concurrency} requests={len(samples)} errors={len(errors)} "
+          f"rps={len(samples) / wall:.0f} p50={pct(s, 50) * 1e3:.1f}ms p99={pct(s, 99) * 1e3:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()